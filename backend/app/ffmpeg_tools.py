@@ -1,14 +1,28 @@
 """FFmpeg utilities for video and image processing."""
-import json
+import os
 import re
 import shutil
 import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
+from functools import lru_cache
 from pathlib import Path
-from statistics import median
 from typing import Optional
 
 
+# Executables resolved once at import; fall back to a PATH lookup at spawn
+# time if they were not installed when the server started. On Linux CPython
+# spawns children with vfork() instead of copying the server's page tables
+# unless preexec_fn or a user/group change is requested, so ffmpeg launches
+# avoid those options.
+FFMPEG_BIN = shutil.which("ffmpeg") or "ffmpeg"
+FFPROBE_BIN = shutil.which("ffprobe") or "ffprobe"
+
+# Six uppercase hex digits (input is uppercased before matching)
+_HEX_COLOR_RE = re.compile(r"[0-9A-F]{6}")
+
+
 class InvalidParameterError(ValueError):
     """Raised when a parameter fails validation."""
     pass
@@ -27,7 +41,7 @@ def validate_hex_color(hex_color: str) -> str:
         InvalidParameterError: If the color format is invalid
     """
     color = hex_color.lstrip("#").upper()
-    if not re.match(r"^[0-9A-F]{6}$", color):
+    if not _HEX_COLOR_RE.fullmatch(color):
         raise InvalidParameterError(
             f"Invalid hex color format: {hex_color}. Expected 6 hex characters (e.g., '00FF00')"
         )
@@ -58,7 +72,21 @@ def validate_chromakey_params(similarity: float, blend: float) -> tuple[float, f
     return float(similarity), float(blend)
 
 
-@dataclass
+@lru_cache(maxsize=256)
+def _chromakey_vf(hex_color: str, similarity: float, blend: float, pix_fmt: str) -> str:
+    """Build the validated chromakey filter chain ending in pix_fmt.
+
+    Cached because preview requests repeat the same parameters while the
+    user drags a slider; invalid input raises and is never cached.
+    """
+    # Validate parameters to prevent command injection
+    validated_color = validate_hex_color(hex_color)
+    validated_similarity, validated_blend = validate_chromakey_params(similarity, blend)
+
+    return f"chromakey=0x{validated_color}:{validated_similarity}:{validated_blend},format={pix_fmt}"
+
+
+@dataclass(frozen=True)
 class VideoMetadata:
     """Video metadata from ffprobe."""
     duration: float
@@ -68,7 +96,7 @@ class VideoMetadata:
     has_audio: bool
 
 
-@dataclass
+@dataclass(frozen=True)
 class ImageMetadata:
     """Image metadata from ffprobe."""
     width: int
@@ -96,23 +124,23 @@ def check_ffmpeg() -> tuple[bool, Optional[str], Optional[str]]:
     if not ffmpeg_path or not ffprobe_path:
         return False, None, None
 
+    processes = []
     try:
-        ffmpeg_result = subprocess.run(
-            ["ffmpeg", "-version"],
-            capture_output=True,
-            text=True,
-            timeout=10
-        )
-        ffprobe_result = subprocess.run(
-            ["ffprobe", "-version"],
-            capture_output=True,
-            text=True,
-            timeout=10
-        )
-
-        ffmpeg_version = ffmpeg_result.stdout.split("\n")[0] if ffmpeg_result.returncode == 0 else None
-        ffprobe_version = ffprobe_result.stdout.split("\n")[0] if ffprobe_result.returncode == 0 else None
-
+        # Start both version checks before waiting so they run concurrently
+        for tool_path in (ffmpeg_path, ffprobe_path):
+            processes.append(subprocess.Popen(
+                [tool_path, "-version"],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+                text=True
+            ))
+
+        versions = []
+        for process in processes:
+            stdout, _ = process.communicate(timeout=10)
+            versions.append(stdout.split("\n")[0] if process.returncode == 0 else None)
+
+        ffmpeg_version, ffprobe_version = versions
         return True, ffmpeg_version, ffprobe_version
     except subprocess.TimeoutExpired:
         # ffmpeg check timed out - may indicate system issues
@@ -123,17 +151,92 @@ def check_ffmpeg() -> tuple[bool, Optional[str], Optional[str]]:
     except OSError as e:
         # File not found or permission denied
         return False, None, None
+    finally:
+        # Do not leave a hung version check behind
+        for process in processes:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+
+
+# One lock per probe in flight, so concurrent requests for the same file
+# wait for the first ffprobe instead of each starting their own. Each entry
+# is [lock, callers using it] and is removed when the last caller is done.
+_probe_locks: dict[tuple, list] = {}
+_probe_locks_guard = threading.Lock()
+
+
+def _cached_probe(probe, path: Path):
+    """Call a cached probe helper for path, running ffprobe at most once."""
+    stat = path.stat()
+    args = (str(path), stat.st_size, stat.st_mtime_ns)
+    key = (probe, *args)
+
+    with _probe_locks_guard:
+        entry = _probe_locks.get(key)
+        if entry is None:
+            entry = _probe_locks[key] = [threading.Lock(), 0]
+        entry[1] += 1
+    try:
+        with entry[0]:
+            return probe(*args)
+    finally:
+        # Keep the lock while others wait on it (a failed probe is not cached,
+        # so they probe again one at a time); later callers hit the lru_cache
+        with _probe_locks_guard:
+            entry[1] -= 1
+            if entry[1] == 0 and _probe_locks.get(key) is entry:
+                del _probe_locks[key]
 
 
 def get_video_metadata(video_path: Path) -> VideoMetadata:
-    """Get video metadata using ffprobe."""
+    """Get video metadata using ffprobe.
+
+    Results are cached per (path, size, mtime), so probing an unchanged
+    file again does not spawn another ffprobe process, even when several
+    requests ask for it at the same time.
+    """
+    return _cached_probe(_probe_video_metadata, video_path)
+
+
+def get_image_metadata(image_path: Path) -> ImageMetadata:
+    """Get image metadata using ffprobe.
+
+    Results are cached per (path, size, mtime) like get_video_metadata.
+    """
+    return _cached_probe(_probe_image_metadata, image_path)
+
+
+def _parse_compact_output(output: str) -> list[tuple[str, dict[str, str]]]:
+    """Parse ffprobe `-of compact` output into (section, fields) pairs.
+
+    Each line looks like "stream|codec_type=video|width=1920|...".
+    Fields reported as N/A are omitted so callers can apply defaults.
+    """
+    sections = []
+    for line in output.splitlines():
+        name, _, rest = line.partition("|")
+        if not name:
+            continue
+        fields = {}
+        for item in rest.split("|"):
+            key, sep, value = item.partition("=")
+            if sep and value != "N/A":
+                fields[key] = value
+        sections.append((name, fields))
+    return sections
+
+
+@lru_cache(maxsize=256)
+def _probe_video_metadata(video_path: str, size: int, mtime_ns: int) -> VideoMetadata:
+    """Run ffprobe for video metadata (size and mtime_ns only key the cache)."""
+    # Request only the fields we use, as one compact line per section
     cmd = [
-        "ffprobe",
+        FFPROBE_BIN,
         "-v", "quiet",
-        "-print_format", "json",
-        "-show_format",
-        "-show_streams",
-        str(video_path)
+        "-show_entries", "stream=codec_type,width,height,r_frame_rate,duration:format=duration",
+        "-of", "compact",
+        video_path
     ]
 
     result = subprocess.run(cmd, capture_output=True, text=True, timeout=30)
@@ -141,23 +244,24 @@ def get_video_metadata(video_path: Path) -> VideoMetadata:
     if result.returncode != 0:
         raise RuntimeError(f"ffprobe failed: {result.stderr}")
 
-    data = json.loads(result.stdout)
-
     # Find video stream
     video_stream = None
     has_audio = False
-
-    for stream in data.get("streams", []):
-        if stream.get("codec_type") == "video" and video_stream is None:
-            video_stream = stream
-        elif stream.get("codec_type") == "audio":
+    format_info = {}
+
+    for section, fields in _parse_compact_output(result.stdout):
+        if section == "format":
+            format_info = fields
+        elif fields.get("codec_type") == "video" and video_stream is None:
+            video_stream = fields
+        elif fields.get("codec_type") == "audio":
             has_audio = True
 
     if not video_stream:
         raise RuntimeError("No video stream found in file")
 
     # Parse duration
-    duration = float(data.get("format", {}).get("duration", 0))
+    duration = float(format_info.get("duration", 0))
     if duration == 0:
         duration = float(video_stream.get("duration", 0))
 
@@ -182,14 +286,15 @@ def get_video_metadata(video_path: Path) -> VideoMetadata:
     )
 
 
-def get_image_metadata(image_path: Path) -> ImageMetadata:
-    """Get image metadata using ffprobe."""
+@lru_cache(maxsize=256)
+def _probe_image_metadata(image_path: str, size: int, mtime_ns: int) -> ImageMetadata:
+    """Run ffprobe for image metadata (size and mtime_ns only key the cache)."""
     cmd = [
-        "ffprobe",
+        FFPROBE_BIN,
         "-v", "quiet",
-        "-print_format", "json",
-        "-show_streams",
-        str(image_path)
+        "-show_entries", "stream=codec_type,width,height",
+        "-of", "compact",
+        image_path
     ]
 
     result = subprocess.run(cmd, capture_output=True, text=True, timeout=30)
@@ -197,13 +302,11 @@ def get_image_metadata(image_path: Path) -> ImageMetadata:
     if result.returncode != 0:
         raise RuntimeError(f"ffprobe failed: {result.stderr}")
 
-    data = json.loads(result.stdout)
-
     # Find video/image stream
     image_stream = None
-    for stream in data.get("streams", []):
-        if stream.get("codec_type") == "video":
-            image_stream = stream
+    for section, fields in _parse_compact_output(result.stdout):
+        if section == "stream" and fields.get("codec_type") == "video":
+            image_stream = fields
             break
 
     if not image_stream:
@@ -215,21 +318,47 @@ def get_image_metadata(image_path: Path) -> ImageMetadata:
     return ImageMetadata(width=width, height=height)
 
 
+# An (r, g, b) color with 0-255 integer channels
+RGB = tuple[int, int, int]
+
+# Corner crop filters (CORNER_SIZE x CORNER_SIZE regions)
+CORNER_SIZE = 20
+CORNER_CROPS = [
+    f"crop={CORNER_SIZE}:{CORNER_SIZE}:0:0",                                # Top-left
+    f"crop={CORNER_SIZE}:{CORNER_SIZE}:iw-{CORNER_SIZE}:0",                 # Top-right
+    f"crop={CORNER_SIZE}:{CORNER_SIZE}:0:ih-{CORNER_SIZE}",                 # Bottom-left
+    f"crop={CORNER_SIZE}:{CORNER_SIZE}:iw-{CORNER_SIZE}:ih-{CORNER_SIZE}",  # Bottom-right
+]
+
+
+def _average_rgb(pixels: bytes) -> RGB:
+    """Average color of packed rgb24 pixel data."""
+    count = len(pixels) // 3
+    end = count * 3
+    return (
+        round(sum(pixels[0:end:3]) / count),
+        round(sum(pixels[1:end:3]) / count),
+        round(sum(pixels[2:end:3]) / count),
+    )
+
+
 def sample_color_at_region(
     file_path: Path,
     crop_filter: str,
     time: Optional[float] = None
-) -> Optional[tuple[int, int, int]]:
+) -> Optional[RGB]:
     """Sample average color at a specific region and optional time (for videos)."""
-    cmd = ["ffmpeg"]
+    cmd = [FFMPEG_BIN]
 
     # Add time seek only for videos (when time is provided)
     if time is not None:
         cmd.extend(["-ss", str(time)])
 
+    # Read the raw region and average it here rather than asking swscale
+    # to resample it down to one pixel
     cmd.extend([
         "-i", str(file_path),
-        "-vf", f"{crop_filter},scale=1:1",
+        "-vf", crop_filter,
         "-frames:v", "1",
         "-f", "rawvideo",
         "-pix_fmt", "rgb24",
@@ -245,32 +374,117 @@ def sample_color_at_region(
     if result.returncode != 0 or len(result.stdout) < 3:
         return None
 
-    r, g, b = result.stdout[0], result.stdout[1], result.stdout[2]
-    return (r, g, b)
+    return _average_rgb(result.stdout)
+
+
+def build_corner_sample_command(
+    file_path: Path,
+    timestamps: Optional[list[float]] = None
+) -> list[str]:
+    """Build a single ffmpeg command that samples every corner at every timestamp.
+
+    Corner regions are stacked horizontally and timestamps vertically, so
+    the command writes one rgb24 frame made of len(CORNER_CROPS) x
+    len(timestamps) blocks of CORNER_SIZE x CORNER_SIZE pixels to stdout.
+    For images, timestamps is None and a single row is produced.
+    """
+    cmd = [FFMPEG_BIN]
+
+    # One input per timestamp so each row uses a fast input seek
+    seeks = timestamps if timestamps else [None]
+    for t in seeks:
+        if t is not None:
+            cmd.extend(["-ss", str(t)])
+        cmd.extend(["-i", str(file_path)])
+
+    n_corners = len(CORNER_CROPS)
+    graph = []
+    for i in range(len(seeks)):
+        split_labels = "".join(f"[s{i}_{j}]" for j in range(n_corners))
+        graph.append(f"[{i}:v]split={n_corners}{split_labels}")
+        for j, crop in enumerate(CORNER_CROPS):
+            # Convert each region to rgb24 so stacking never mixes subsampled chroma
+            graph.append(f"[s{i}_{j}]{crop},format=rgb24[c{i}_{j}]")
+        corner_labels = "".join(f"[c{i}_{j}]" for j in range(n_corners))
+        graph.append(f"{corner_labels}hstack=inputs={n_corners}[row{i}]")
+
+    if len(seeks) > 1:
+        row_labels = "".join(f"[row{i}]" for i in range(len(seeks)))
+        graph.append(f"{row_labels}vstack=inputs={len(seeks)}[out]")
+        out_label = "[out]"
+    else:
+        out_label = "[row0]"
+
+    cmd.extend([
+        "-filter_complex", ";".join(graph),
+        "-map", out_label,
+        "-frames:v", "1",
+        "-f", "rawvideo",
+        "-pix_fmt", "rgb24",
+        "-"
+    ])
+
+    return cmd
+
+
+def sample_corner_colors(
+    file_path: Path,
+    timestamps: Optional[list[float]] = None
+) -> list[RGB]:
+    """Sample all corners at all timestamps with a single ffmpeg invocation.
+
+    Returns the average (r, g, b) of each corner region, row by row, or an
+    empty list if sampling failed.
+    """
+    cmd = build_corner_sample_command(file_path, timestamps)
+
+    result = subprocess.run(
+        cmd,
+        capture_output=True,
+        timeout=30
+    )
+
+    n_rows = len(timestamps or [None])
+    n_corners = len(CORNER_CROPS)
+    block_bytes = CORNER_SIZE * 3
+    row_stride = n_corners * block_bytes
+
+    if result.returncode != 0 or len(result.stdout) < row_stride * CORNER_SIZE * n_rows:
+        return []
+
+    data = result.stdout
+    samples = []
+    for i in range(n_rows):
+        for j in range(n_corners):
+            # Gather the block's pixel rows out of the stacked frame
+            first = i * CORNER_SIZE * row_stride + j * block_bytes
+            block = b"".join(
+                data[first + y * row_stride:first + y * row_stride + block_bytes]
+                for y in range(CORNER_SIZE)
+            )
+            samples.append(_average_rgb(block))
+    return samples
+
+
+def _median_channel(values: tuple[int, ...]) -> int:
+    """Median of integer channel values, averaging (floored) the middle pair."""
+    ordered = sorted(values)
+    mid = len(ordered) // 2
+    if len(ordered) % 2:
+        return ordered[mid]
+    return (ordered[mid - 1] + ordered[mid]) // 2
 
 
 def estimate_background_color(
     file_path: Path,
     duration: Optional[float] = None
-) -> tuple[str, tuple[int, int, int], int]:
+) -> tuple[str, RGB, int]:
     """
     Estimate background color by sampling corners.
     For videos: samples at multiple timestamps.
     For images: samples corners once (no time parameter).
     Returns (hex, rgb_tuple, sample_count).
     """
-    # Corner crop filters
-    corners = [
-        "crop=20:20:0:0",           # Top-left
-        "crop=20:20:iw-20:0",       # Top-right
-        "crop=20:20:0:ih-20",       # Bottom-left
-        "crop=20:20:iw-20:ih-20",   # Bottom-right
-    ]
-
-    r_values = []
-    g_values = []
-    b_values = []
-
     # Determine if this is a video (has duration) or image
     is_video = duration is not None and duration > 0
 
@@ -278,34 +492,38 @@ def estimate_background_color(
         # For videos: sample at multiple timestamps
         timestamps = [0.0, 0.5, 1.0]
         timestamps = [min(t, max(0, duration - 0.1)) for t in timestamps]
-
-        for t in timestamps:
-            for crop in corners:
-                color = sample_color_at_region(file_path, crop, time=t)
-                if color:
-                    r_values.append(color[0])
-                    g_values.append(color[1])
-                    b_values.append(color[2])
     else:
         # For images: sample corners once (no time parameter)
-        for crop in corners:
-            color = sample_color_at_region(file_path, crop, time=None)
-            if color:
-                r_values.append(color[0])
-                g_values.append(color[1])
-                b_values.append(color[2])
-
-    if not r_values:
+        timestamps = None
+
+    # Sample everything in one ffmpeg run
+    samples = sample_corner_colors(file_path, timestamps)
+
+    if not samples:
+        # Fall back to sampling each region separately so a single
+        # failing seek does not lose the remaining samples.
+        # The ffmpeg runs are independent, so run them concurrently.
+        tasks = [(crop, t) for t in (timestamps or [None]) for crop in CORNER_CROPS]
+        max_workers = min(len(tasks), os.cpu_count() or 1)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            colors = executor.map(
+                lambda task: sample_color_at_region(file_path, task[0], time=task[1]),
+                tasks
+            )
+            samples = [color for color in colors if color]
+
+    if not samples:
         raise RuntimeError("Failed to sample any colors from file")
 
     # Use median for robustness
-    r = int(median(r_values))
-    g = int(median(g_values))
-    b = int(median(b_values))
+    r_values, g_values, b_values = zip(*samples)
+    r = _median_channel(r_values)
+    g = _median_channel(g_values)
+    b = _median_channel(b_values)
 
     hex_color = f"{r:02X}{g:02X}{b:02X}"
 
-    return hex_color, (r, g, b), len(r_values)
+    return hex_color, (r, g, b), len(samples)
 
 
 def generate_preview(
@@ -322,13 +540,9 @@ def generate_preview(
     For videos, time specifies which frame to use.
     For images, time is ignored.
     """
-    # Validate parameters to prevent command injection
-    validated_color = validate_hex_color(hex_color)
-    validated_similarity, validated_blend = validate_chromakey_params(similarity, blend)
-
-    vf = f"chromakey=0x{validated_color}:{validated_similarity}:{validated_blend},format=rgba,scale={max_width}:-1"
+    vf = f"{_chromakey_vf(hex_color, similarity, blend, 'rgba')},scale={max_width}:-1"
 
-    cmd = ["ffmpeg", "-y"]
+    cmd = [FFMPEG_BIN, "-y"]
 
     # Add time seek only for videos (when time is provided)
     if time is not None:
@@ -362,17 +576,17 @@ def build_render_command(
     blend: float,
     crf: int,
     include_audio: bool,
-    has_audio: bool
+    has_audio: bool,
+    threads: Optional[int] = None
 ) -> list[str]:
-    """Build ffmpeg command for rendering transparent WebM."""
-    # Validate parameters to prevent command injection
-    validated_color = validate_hex_color(hex_color)
-    validated_similarity, validated_blend = validate_chromakey_params(similarity, blend)
+    """Build ffmpeg command for rendering transparent WebM.
 
-    vf = f"chromakey=0x{validated_color}:{validated_similarity}:{validated_blend},format=yuva420p"
+    threads caps ffmpeg's internal threading; None leaves ffmpeg's default.
+    """
+    vf = _chromakey_vf(hex_color, similarity, blend, "yuva420p")
 
     cmd = [
-        "ffmpeg",
+        FFMPEG_BIN,
         "-y",
         "-i", str(input_path),
         "-vf", vf,
@@ -388,6 +602,9 @@ def build_render_command(
     else:
         cmd.append("-an")
 
+    if threads is not None:
+        cmd.extend(["-threads", str(threads)])
+
     cmd.extend([
         "-progress", "pipe:1",
         "-nostats",
@@ -405,17 +622,17 @@ def build_image_render_command(
     blend: float
 ) -> list[str]:
     """Build ffmpeg command for rendering transparent PNG from image."""
-    # Validate parameters to prevent command injection
-    validated_color = validate_hex_color(hex_color)
-    validated_similarity, validated_blend = validate_chromakey_params(similarity, blend)
-
-    vf = f"chromakey=0x{validated_color}:{validated_similarity}:{validated_blend},format=rgba"
+    vf = _chromakey_vf(hex_color, similarity, blend, "rgba")
 
+    # Stop after the first frame: animated GIF/WebP inputs are otherwise
+    # decoded in full and fail to mux into a single PNG
     cmd = [
-        "ffmpeg",
+        FFMPEG_BIN,
         "-y",
         "-i", str(input_path),
         "-vf", vf,
+        "-frames:v", "1",
+        "-update", "1",
         "-f", "image2",
         str(output_path)
     ]
@@ -423,11 +640,47 @@ def build_image_render_command(
     return cmd
 
 
-def parse_progress(line: str) -> Optional[int]:
-    """Parse out_time_ms from ffmpeg progress output."""
-    if line.startswith("out_time_ms="):
+def build_image_batch_render_command(
+    renders: list[tuple[Path, Path, str, float, float]]
+) -> list[str]:
+    """Build one ffmpeg command that renders several transparent PNGs.
+
+    Each entry is (input_path, output_path, hex_color, similarity, blend).
+    Every input gets its own chromakey chain mapped to its own output, so a
+    batch costs a single ffmpeg startup instead of one per image.
+    """
+    cmd = [FFMPEG_BIN, "-y"]
+    graph = []
+
+    for i, (input_path, _, hex_color, similarity, blend) in enumerate(renders):
+        vf = _chromakey_vf(hex_color, similarity, blend, "rgba")
+        cmd.extend(["-i", str(input_path)])
+        graph.append(f"[{i}:v]{vf}[v{i}]")
+
+    cmd.extend(["-filter_complex", ";".join(graph)])
+
+    # One frame per output, as in build_image_render_command
+    for i, (_, output_path, _, _, _) in enumerate(renders):
+        cmd.extend([
+            "-map", f"[v{i}]",
+            "-frames:v", "1",
+            "-update", "1",
+            "-f", "image2",
+            str(output_path)
+        ])
+
+    return cmd
+
+
+def parse_progress(line: bytes) -> Optional[int]:
+    """Parse out_time_ms from a raw ffmpeg progress output line.
+
+    Works on bytes so the progress loop can skip decoding every line.
+    Surrounding whitespace (including the trailing newline) is ignored.
+    """
+    if line.startswith(b"out_time_ms="):
         try:
-            return int(line.split("=")[1])
-        except (ValueError, IndexError):
+            return int(line[12:])
+        except ValueError:
             pass
     return None
@@ -1,8 +1,11 @@
 """Job management for render tasks."""
 import subprocess
 import threading
+import time
 import traceback
-from dataclasses import dataclass, field
+from collections import deque
+from concurrent.futures import Executor, ThreadPoolExecutor
+from dataclasses import dataclass, field, replace
 from datetime import datetime
 from pathlib import Path
 from typing import Optional
@@ -10,15 +13,28 @@ from typing import Optional
 from .ffmpeg_tools import (
     build_render_command,
     build_image_render_command,
+    build_image_batch_render_command,
     parse_progress,
     get_video_metadata,
 )
 from .models import AssetType, JobStatus
-from .settings import get_logger
+from .settings import (
+    FFMPEG_THREADS_PER_RENDER,
+    IMAGE_BATCH_WINDOW,
+    MAX_CONCURRENT_RENDERS,
+    get_logger,
+)
 from .storage import get_output_path, get_log_path, generate_id
 
 logger = get_logger(__name__)
 
+# Number of log lines kept on a job for the status endpoint
+LOG_TAIL_LINES = 10
+
+# Seconds between job progress updates; ffmpeg reports about twice a second
+# and -stats_period, which could slow it down, needs ffmpeg 4.4+
+PROGRESS_UPDATE_INTERVAL = 1.0
+
 
 @dataclass
 class Job:
@@ -39,15 +55,37 @@ class Job:
     started_at: Optional[datetime] = None
     finished_at: Optional[datetime] = None
     process: Optional[subprocess.Popen] = None
-    log_lines: list[str] = field(default_factory=list)
+    log_lines: deque[str] = field(default_factory=lambda: deque(maxlen=LOG_TAIL_LINES))
+    # Set by cancel_job; checked by the render loop without taking the lock
+    cancel_event: threading.Event = field(default_factory=threading.Event)
 
 
 class JobManager:
     """Manager for render jobs."""
 
-    def __init__(self):
+    def __init__(
+        self,
+        executor: Optional[Executor] = None,
+        image_executor: Optional[Executor] = None
+    ):
         self._jobs: dict[str, Job] = {}
         self._lock = threading.Lock()
+        # Video worker pool sized to the CPUs available; jobs wait as
+        # QUEUED until a worker is free
+        self._executor = executor or ThreadPoolExecutor(
+            max_workers=MAX_CONCURRENT_RENDERS,
+            thread_name_prefix="render"
+        )
+        # Image renders take well under a second, so they get their own
+        # worker instead of queueing behind long video encodes
+        self._image_executor = image_executor or ThreadPoolExecutor(
+            max_workers=1,
+            thread_name_prefix="image-render"
+        )
+        # Image jobs waiting to be rendered together in one ffmpeg run
+        self._pending_images: list[str] = []
+        self._image_batch_scheduled = False
+        self._image_batch_timer: Optional[threading.Timer] = None
 
     def create_job(
         self,
@@ -60,7 +98,7 @@ class JobManager:
         crf: Optional[int] = None,
         include_audio: bool = False
     ) -> str:
-        """Create a new render job and start it in background."""
+        """Create a new render job and queue it on the worker pool."""
         job_id = generate_id()
 
         job = Job(
@@ -80,9 +118,20 @@ class JobManager:
 
         logger.info(f"Job created: id={job_id}, asset={asset_id}, type={asset_type.value}")
 
-        # Start render in background thread
-        thread = threading.Thread(target=self._run_render, args=(job_id,), daemon=True)
-        thread.start()
+        if asset_type == AssetType.IMAGE:
+            # Image jobs created within a short window share one ffmpeg run
+            with self._lock:
+                self._pending_images.append(job_id)
+                if not self._image_batch_scheduled:
+                    self._image_batch_scheduled = True
+                    self._image_batch_timer = threading.Timer(
+                        IMAGE_BATCH_WINDOW, self._image_executor.submit, args=(self._run_image_batch,)
+                    )
+                    self._image_batch_timer.daemon = True
+                    self._image_batch_timer.start()
+        else:
+            # Run render on the shared worker pool
+            self._executor.submit(self._run_render, job_id)
 
         return job_id
 
@@ -91,7 +140,15 @@ class JobManager:
         with self._lock:
             return self._jobs.get(job_id)
 
-    def cancel_job(self, job_id: str) -> bool:
+    def get_job_snapshot(self, job_id: str) -> Optional[Job]:
+        """Get a consistent copy of a job's fields for reporting."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if not job:
+                return None
+            return replace(job, log_lines=job.log_lines.copy())
+
+    def cancel_job(self, job_id: str, reason: str = "Canceled by user") -> bool:
         """Cancel a running job."""
         with self._lock:
             job = self._jobs.get(job_id)
@@ -101,6 +158,8 @@ class JobManager:
             if job.status not in (JobStatus.QUEUED, JobStatus.RUNNING):
                 return False
 
+            job.cancel_event.set()
+
             if job.process:
                 job.process.terminate()
                 try:
@@ -110,16 +169,37 @@ class JobManager:
 
             job.status = JobStatus.CANCELED
             job.finished_at = datetime.now()
-            job.message = "Canceled by user"
+            job.message = reason
 
         logger.info(f"Job canceled: id={job_id}")
         return True
 
+    def shutdown(self) -> None:
+        """Drop queued renders and stop running ffmpeg processes.
+
+        Pool workers are not daemon threads and are joined at interpreter
+        exit, so without this stopping the server would first run every
+        queued render to completion.
+        """
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self._image_executor.shutdown(wait=False, cancel_futures=True)
+        with self._lock:
+            if self._image_batch_timer is not None:
+                self._image_batch_timer.cancel()
+            job_ids = [
+                job_id for job_id, job in self._jobs.items()
+                if job.status in (JobStatus.QUEUED, JobStatus.RUNNING)
+            ]
+
+        for job_id in job_ids:
+            self.cancel_job(job_id, reason="Canceled by server shutdown")
+
     def _run_render(self, job_id: str) -> None:
         """Run the render process."""
         with self._lock:
             job = self._jobs.get(job_id)
-            if not job:
+            # Skip jobs canceled while waiting in the queue
+            if not job or job.status != JobStatus.QUEUED:
                 return
             job.status = JobStatus.RUNNING
             job.started_at = datetime.now()
@@ -127,10 +207,11 @@ class JobManager:
         # Determine output extension based on asset type
         is_video = job.asset_type == AssetType.VIDEO
         output_ext = "webm" if is_video else "png"
-        output_path = get_output_path(job_id, output_ext)
-        log_path = get_log_path(job_id)
 
         try:
+            output_path = get_output_path(job_id, output_ext)
+            log_path = get_log_path(job_id)
+
             if is_video:
                 # Video rendering with progress tracking
                 metadata = get_video_metadata(job.input_path)
@@ -144,41 +225,48 @@ class JobManager:
                     blend=job.blend,
                     crf=job.crf or 24,
                     include_audio=job.include_audio,
-                    has_audio=metadata.has_audio
+                    has_audio=metadata.has_audio,
+                    threads=FFMPEG_THREADS_PER_RENDER
                 )
 
                 with self._lock:
                     job.log_lines.append(f"Command: {' '.join(cmd)}")
 
+                # Binary pipes: progress lines are parsed as bytes
                 process = subprocess.Popen(
                     cmd,
                     stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                    text=True
+                    stderr=subprocess.PIPE
                 )
 
                 with self._lock:
                     job.process = process
 
+                # Keep only the raw tail of the log for the job status
+                tail: deque[bytes] = deque(maxlen=LOG_TAIL_LINES)
+                last_progress_at = float("-inf")
+
                 # Read progress from stdout with proper resource management
-                with open(log_path, "w") as log_file:
+                with open(log_path, "wb") as log_file:
                     while True:
-                        with self._lock:
-                            if job.status == JobStatus.CANCELED:
-                                break
+                        if job.cancel_event.is_set():
+                            break
 
                         line = process.stdout.readline()
                         if not line:
                             break
 
                         log_file.write(line)
-                        log_file.flush()
+                        tail.append(line)
 
-                        out_time_ms = parse_progress(line.strip())
+                        out_time_ms = parse_progress(line)
                         if out_time_ms is not None and duration_ms > 0:
-                            progress = min(1.0, out_time_ms / duration_ms)
-                            with self._lock:
-                                job.progress = progress
+                            now = time.monotonic()
+                            if now - last_progress_at >= PROGRESS_UPDATE_INTERVAL:
+                                last_progress_at = now
+                                # A single float assignment is atomic under the GIL;
+                                # readers that need several fields use get_job_snapshot
+                                job.progress = min(1.0, out_time_ms / duration_ms)
 
                     # Wait for process to finish
                     process.wait()
@@ -186,8 +274,12 @@ class JobManager:
                     # Capture stderr
                     stderr = process.stderr.read()
                     if stderr:
-                        log_file.write("\n--- STDERR ---\n")
+                        log_file.write(b"\n--- STDERR ---\n")
                         log_file.write(stderr)
+                        tail.extend([b"", b"--- STDERR ---"])
+                        tail.extend(stderr.splitlines())
+
+                last_lines = [line.decode(errors="replace").strip() for line in tail]
             else:
                 # Image rendering (instant, no progress tracking needed)
                 cmd = build_image_render_command(
@@ -206,17 +298,20 @@ class JobManager:
                     cmd,
                     capture_output=True,
                     text=True,
+                    errors="replace",
                     timeout=60
                 )
 
                 # Write log
+                log_text = f"Command: {' '.join(cmd)}\n"
+                if result.stdout:
+                    log_text += result.stdout
+                if result.stderr:
+                    log_text += "\n--- STDERR ---\n" + result.stderr
                 with open(log_path, "w") as log_file:
-                    log_file.write(f"Command: {' '.join(cmd)}\n")
-                    if result.stdout:
-                        log_file.write(result.stdout)
-                    if result.stderr:
-                        log_file.write("\n--- STDERR ---\n")
-                        log_file.write(result.stderr)
+                    log_file.write(log_text)
+
+                last_lines = [line.strip() for line in log_text.splitlines()[-LOG_TAIL_LINES:]]
 
                 # Set process return code for later check
                 class FakeProcess:
@@ -224,11 +319,6 @@ class JobManager:
                         self.returncode = returncode
                 process = FakeProcess(result.returncode)
 
-            # Read last log lines
-            with open(log_path, "r") as f:
-                all_lines = f.readlines()
-                last_lines = [line.strip() for line in all_lines[-10:]]
-
             with self._lock:
                 if job.status == JobStatus.CANCELED:
                     return
@@ -244,7 +334,8 @@ class JobManager:
                     logger.error(f"Job failed: id={job_id}, returncode={process.returncode}")
 
                 job.finished_at = datetime.now()
-                job.log_lines = last_lines
+                job.log_lines.clear()
+                job.log_lines.extend(last_lines)
 
         except subprocess.TimeoutExpired as e:
             logger.error(f"Job timed out: id={job_id}, timeout={e.timeout}s")
@@ -275,6 +366,124 @@ class JobManager:
                 job.finished_at = datetime.now()
 
 
+    def _run_image_batch(self) -> None:
+        """Render all pending image jobs with a single ffmpeg process."""
+        with self._lock:
+            job_ids = self._pending_images
+            self._pending_images = []
+            self._image_batch_scheduled = False
+            jobs = [
+                self._jobs[job_id] for job_id in job_ids
+                if self._jobs[job_id].status == JobStatus.QUEUED
+            ]
+
+        if len(jobs) <= 1:
+            for job in jobs:
+                self._run_render(job.job_id)
+            return
+
+        try:
+            output_paths = {job.job_id: get_output_path(job.job_id, "png") for job in jobs}
+            cmd = build_image_batch_render_command([
+                (job.input_path, output_paths[job.job_id], job.hex_color, job.similarity, job.blend)
+                for job in jobs
+            ])
+        except Exception as e:
+            # This runs as a fire-and-forget pool task, so an exception here
+            # would leave the jobs QUEUED; single renders report their own errors
+            logger.warning(f"Image batch setup failed, rendering jobs individually: error={e}")
+            for job in jobs:
+                self._run_render(job.job_id)
+            return
+
+        with self._lock:
+            started_at = datetime.now()
+            for job in jobs:
+                job.status = JobStatus.RUNNING
+                job.started_at = started_at
+                job.log_lines.append(f"Command: {' '.join(cmd)}")
+
+        try:
+            self._run_image_batch_command(jobs, output_paths, cmd)
+        except Exception as e:
+            # Nothing waits on this pool task, so an unexpected error must not
+            # leave jobs of the batch unfinished
+            error_details = traceback.format_exc()
+            logger.error(f"Image batch unexpected error: error={e}\n{error_details}")
+            with self._lock:
+                for job in jobs:
+                    if job.status in (JobStatus.QUEUED, JobStatus.RUNNING):
+                        job.status = JobStatus.ERROR
+                        job.message = f"Unexpected error: {e}"
+                        job.finished_at = datetime.now()
+
+    def _run_image_batch_command(
+        self,
+        jobs: list[Job],
+        output_paths: dict[str, Path],
+        cmd: list[str]
+    ) -> None:
+        """Run a batch command and record the result on each job."""
+        logger.info(f"Image batch started: jobs={len(jobs)}")
+
+        try:
+            result = subprocess.run(
+                cmd,
+                capture_output=True,
+                text=True,
+                errors="replace",
+                timeout=60
+            )
+        except (subprocess.SubprocessError, OSError) as e:
+            logger.warning(f"Image batch failed to run: error={e}")
+            result = None
+
+        if result is None or result.returncode != 0:
+            # One unreadable input fails the whole batch, so render each job on its own
+            logger.warning("Image batch failed, rendering jobs individually")
+            with self._lock:
+                for job in jobs:
+                    if job.status == JobStatus.RUNNING:
+                        job.status = JobStatus.QUEUED
+                        job.started_at = None
+                        job.log_lines.clear()
+            for job in jobs:
+                self._run_render(job.job_id)
+            return
+
+        last_lines = [line.strip() for line in result.stderr.splitlines()[-LOG_TAIL_LINES:]]
+
+        for job in jobs:
+            try:
+                with open(get_log_path(job.job_id), "w") as log_file:
+                    log_file.write(f"Command: {' '.join(cmd)}\n")
+                    if result.stdout:
+                        log_file.write(result.stdout)
+                    if result.stderr:
+                        log_file.write("\n--- STDERR ---\n")
+                        log_file.write(result.stderr)
+            except OSError as e:
+                logger.error(f"Failed to write job log: id={job.job_id}, error={e}")
+
+            with self._lock:
+                if job.status == JobStatus.CANCELED:
+                    continue
+
+                if output_paths[job.job_id].exists():
+                    job.status = JobStatus.DONE
+                    job.progress = 1.0
+                    job.message = "Render completed successfully"
+                    logger.info(f"Job completed: id={job.job_id}")
+                else:
+                    job.status = JobStatus.ERROR
+                    job.message = "FFmpeg did not produce an output file"
+                    logger.error(f"Job failed: id={job.job_id}, missing output")
+
+                job.finished_at = datetime.now()
+                job.log_lines.clear()
+                job.log_lines.extend(last_lines)
+
+
 # Global job manager instance (default singleton for production)
 _job_manager: Optional[JobManager] = None
 
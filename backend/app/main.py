@@ -1,7 +1,15 @@
 """FastAPI application for AutoChroma Mini Studio."""
-from fastapi import FastAPI, HTTPException, UploadFile, File, Request, Depends
+import asyncio
+import hashlib
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import Optional
+
+from fastapi import FastAPI, HTTPException, UploadFile, File, Request, Depends, Header
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, Response, JSONResponse
+from fastapi.responses import FileResponse, JSONResponse, Response
 
 from .ffmpeg_tools import (
     check_ffmpeg,
@@ -13,6 +21,7 @@ from .ffmpeg_tools import (
 from .jobs import JobManager, get_job_manager
 from .models import (
     AssetType,
+    JobStatus,
     ProbeResponse,
     AssetResponse,
     EstimateKeyResponse,
@@ -23,9 +32,17 @@ from .models import (
     JobResponse,
     CancelResponse,
 )
-from .settings import CORS_ORIGINS, MAX_UPLOAD_SIZE, UPLOAD_CHUNK_SIZE, setup_logging, get_logger
+from .settings import (
+    CORS_ORIGINS,
+    MAX_CONCURRENT_PREVIEWS,
+    MAX_UPLOAD_SIZE,
+    PREVIEW_CACHE_SIZE,
+    UPLOAD_CHUNK_SIZE,
+    setup_logging,
+    get_logger,
+)
 
-# Initialize logging
+# Initialize logging; data directories are created by storage on first use
 setup_logging()
 logger = get_logger(__name__)
 
@@ -34,19 +51,30 @@ from .storage import (
     safe_filename,
     get_extension,
     get_asset_path,
+    forget_asset_path,
     find_asset_path,
-    get_output_path,
+    find_output_path,
     get_preview_path,
+    get_asset_type,
     is_video_extension,
     is_image_extension,
     get_valid_extensions,
     InvalidIdError,
 )
 
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Stop render workers on shutdown so queued jobs don't delay exit."""
+    yield
+    await run_in_threadpool(get_job_manager().shutdown)
+
+
 app = FastAPI(
     title="AutoChroma Mini Studio API",
     description="API for video chromakey transparency processing",
     version="0.1.0",
+    lifespan=lifespan,
 )
 
 # CORS middleware
@@ -59,6 +87,17 @@ app.add_middleware(
 )
 
 
+# Caps interactive ffmpeg runs so a burst of preview requests can't
+# oversubscribe the CPUs; renders are capped by the JobManager pool
+_ffmpeg_slots = asyncio.Semaphore(MAX_CONCURRENT_PREVIEWS)
+
+# Recent previews by render parameters: key -> (preview_id, path). Releasing
+# a slider on a value already tried reuses the PNG instead of running ffmpeg.
+# The 304 reply only applies to clients that send If-None-Match; the bundled
+# frontend does not, so for it the reuse is server-side only.
+_preview_cache: OrderedDict[str, tuple[str, Path]] = OrderedDict()
+
+
 @app.exception_handler(InvalidIdError)
 async def invalid_id_exception_handler(request: Request, exc: InvalidIdError):
     """Handle invalid ID format errors."""
@@ -68,7 +107,7 @@ async def invalid_id_exception_handler(request: Request, exc: InvalidIdError):
 @app.get("/api/probe", response_model=ProbeResponse)
 async def probe_ffmpeg():
     """Check if ffmpeg and ffprobe are available."""
-    ok, ffmpeg_version, ffprobe_version = check_ffmpeg()
+    ok, ffmpeg_version, ffprobe_version = await run_in_threadpool(check_ffmpeg)
 
     if not ok:
         return ProbeResponse(
@@ -90,18 +129,15 @@ async def upload_asset(file: UploadFile = File(...)):
     if not file.filename:
         raise HTTPException(status_code=400, detail="No filename provided")
 
-    # Validate file extension
+    # Validate file extension and determine asset type
     extension = get_extension(file.filename)
-    valid_extensions = get_valid_extensions()
-    if extension not in valid_extensions:
+    asset_type = get_asset_type(extension)
+    if asset_type is None:
         raise HTTPException(
             status_code=400,
-            detail=f"Invalid file type. Supported formats: {', '.join(sorted(valid_extensions))}"
+            detail=f"Invalid file type. Supported formats: {', '.join(sorted(get_valid_extensions()))}"
         )
-
-    # Determine asset type
-    is_video = is_video_extension(extension)
-    asset_type = AssetType.VIDEO if is_video else AssetType.IMAGE
+    is_video = asset_type == AssetType.VIDEO
 
     asset_id = generate_id()
     asset_path = get_asset_path(asset_id, extension)
@@ -115,23 +151,26 @@ async def upload_asset(file: UploadFile = File(...)):
                 if total_size > MAX_UPLOAD_SIZE:
                     f.close()
                     asset_path.unlink(missing_ok=True)
+                    forget_asset_path(asset_id)
                     raise HTTPException(
                         status_code=413,
                         detail=f"File too large. Maximum size is {MAX_UPLOAD_SIZE // (1024 * 1024)}MB"
                     )
-                f.write(chunk)
+                # Write off the event loop so large uploads don't stall other requests
+                await run_in_threadpool(f.write, chunk)
     except HTTPException:
         raise
     except Exception as e:
         asset_path.unlink(missing_ok=True)
+        forget_asset_path(asset_id)
         raise HTTPException(status_code=500, detail=f"Failed to save file: {e}")
 
     # Get metadata based on asset type
     try:
         if is_video:
-            metadata = get_video_metadata(asset_path)
+            metadata = await run_in_threadpool(get_video_metadata, asset_path)
             logger.info(f"Asset uploaded: id={asset_id}, type=video, size={total_size}, dimensions={metadata.width}x{metadata.height}")
-            return AssetResponse(
+            return AssetResponse.model_construct(
                 asset_id=asset_id,
                 filename=safe_filename(file.filename),
                 asset_type=asset_type,
@@ -142,9 +181,9 @@ async def upload_asset(file: UploadFile = File(...)):
                 has_audio=metadata.has_audio
             )
         else:
-            metadata = get_image_metadata(asset_path)
+            metadata = await run_in_threadpool(get_image_metadata, asset_path)
             logger.info(f"Asset uploaded: id={asset_id}, type=image, size={total_size}, dimensions={metadata.width}x{metadata.height}")
-            return AssetResponse(
+            return AssetResponse.model_construct(
                 asset_id=asset_id,
                 filename=safe_filename(file.filename),
                 asset_type=asset_type,
@@ -158,6 +197,7 @@ async def upload_asset(file: UploadFile = File(...)):
         # Clean up on failure
         logger.error(f"Failed to read metadata for asset {asset_id}: {e}")
         asset_path.unlink(missing_ok=True)
+        forget_asset_path(asset_id)
         raise HTTPException(
             status_code=400,
             detail=f"Failed to read file metadata. Is this a valid {'video' if is_video else 'image'} file? Error: {e}"
@@ -177,11 +217,16 @@ async def estimate_key(asset_id: str):
         is_video = is_video_extension(extension)
 
         if is_video:
-            metadata = get_video_metadata(asset_path)
-            hex_color, rgb, samples = estimate_background_color(asset_path, metadata.duration)
+            metadata = await run_in_threadpool(get_video_metadata, asset_path)
+            duration = metadata.duration
         else:
             # For images, duration is None
-            hex_color, rgb, samples = estimate_background_color(asset_path, None)
+            duration = None
+
+        async with _ffmpeg_slots:
+            hex_color, rgb, samples = await run_in_threadpool(
+                estimate_background_color, asset_path, duration
+            )
     except Exception as e:
         raise HTTPException(
             status_code=500,
@@ -196,7 +241,11 @@ async def estimate_key(asset_id: str):
 
 
 @app.post("/api/assets/{asset_id}/preview")
-async def create_preview(asset_id: str, request: PreviewRequest):
+async def create_preview(
+    asset_id: str,
+    request: PreviewRequest,
+    if_none_match: Optional[str] = Header(default=None)
+):
     """Generate preview image with chromakey applied."""
     asset_path = find_asset_path(asset_id)
     if not asset_path:
@@ -210,7 +259,7 @@ async def create_preview(asset_id: str, request: PreviewRequest):
     time = None
     if is_video:
         try:
-            metadata = get_video_metadata(asset_path)
+            metadata = await run_in_threadpool(get_video_metadata, asset_path)
             if request.time is not None:
                 time = min(request.time, metadata.duration - 0.1)
                 time = max(0, time)
@@ -219,33 +268,50 @@ async def create_preview(asset_id: str, request: PreviewRequest):
         except Exception as e:
             raise HTTPException(status_code=500, detail=f"Failed to read video: {e}")
 
-    preview_id = generate_id()
-    preview_path = get_preview_path(preview_id)
+    hex_color = request.hex.upper()
+    preview_key = hashlib.blake2b(
+        f"{asset_id}:{hex_color}:{request.similarity}:{request.blend}:{time}:{request.max_width}".encode(),
+        digest_size=16
+    ).hexdigest()
+    etag = f'"{preview_key}"'
+
+    cached = _preview_cache.get(preview_key)
+    if cached and cached[1].exists():
+        _preview_cache.move_to_end(preview_key)
+        preview_id, preview_path = cached
+        if if_none_match == etag:
+            return Response(status_code=304, headers={"ETag": etag, "X-Preview-Id": preview_id})
+    else:
+        preview_id = generate_id()
+        preview_path = get_preview_path(preview_id)
 
-    try:
-        generate_preview(
-            input_path=asset_path,
-            output_path=preview_path,
-            hex_color=request.hex.upper(),
-            similarity=request.similarity,
-            blend=request.blend,
-            time=time,
-            max_width=request.max_width
-        )
-    except Exception as e:
-        raise HTTPException(
-            status_code=500,
-            detail=f"Failed to generate preview: {e}"
-        )
+        try:
+            async with _ffmpeg_slots:
+                await run_in_threadpool(
+                    generate_preview,
+                    input_path=asset_path,
+                    output_path=preview_path,
+                    hex_color=hex_color,
+                    similarity=request.similarity,
+                    blend=request.blend,
+                    time=time,
+                    max_width=request.max_width
+                )
+        except Exception as e:
+            raise HTTPException(
+                status_code=500,
+                detail=f"Failed to generate preview: {e}"
+            )
 
-    # Read and return PNG
-    with open(preview_path, "rb") as f:
-        png_data = f.read()
+        _preview_cache[preview_key] = (preview_id, preview_path)
+        if len(_preview_cache) > PREVIEW_CACHE_SIZE:
+            _preview_cache.popitem(last=False)
 
-    return Response(
-        content=png_data,
+    # Stream the PNG from disk instead of buffering it in memory
+    return FileResponse(
+        path=preview_path,
         media_type="image/png",
-        headers={"X-Preview-Id": preview_id}
+        headers={"ETag": etag, "X-Preview-Id": preview_id}
     )
 
 
@@ -276,7 +342,7 @@ async def start_render(
         include_audio=request.include_audio if is_video else False
     )
 
-    return RenderResponse(job_id=job_id)
+    return RenderResponse.model_construct(job_id=job_id)
 
 
 @app.get("/api/jobs/{job_id}", response_model=JobResponse)
@@ -285,17 +351,25 @@ async def get_job_status(
     job_manager: JobManager = Depends(get_job_manager)
 ):
     """Get job status and progress."""
-    job = job_manager.get_job(job_id)
+    job = job_manager.get_job_snapshot(job_id)
     if not job:
         raise HTTPException(status_code=404, detail="Job not found")
 
     # Determine output extension based on asset type
     is_video = job.asset_type == AssetType.VIDEO
     output_ext = "webm" if is_video else "png"
-    output_path = get_output_path(job_id, output_ext)
-    output_size = output_path.stat().st_size if output_path.exists() else None
 
-    return JobResponse(
+    # The output is only complete once the job is done; skip the stat while polling
+    output_filename = None
+    output_size = None
+    if job.status == JobStatus.DONE:
+        output_path = find_output_path(job_id, output_ext)
+        if output_path.exists():
+            output_filename = f"out.{output_ext}"
+            output_size = output_path.stat().st_size
+
+    # Built from server state only, so skip re-validating every poll
+    return JobResponse.model_construct(
         job_id=job.job_id,
         status=job.status,
         progress=round(job.progress, 3),
@@ -303,9 +377,9 @@ async def get_job_status(
         created_at=job.created_at,
         started_at=job.started_at,
         finished_at=job.finished_at,
-        output_filename=f"out.{output_ext}" if output_path.exists() else None,
+        output_filename=output_filename,
         output_size_bytes=output_size,
-        last_log_lines=job.log_lines[-10:]
+        last_log_lines=list(job.log_lines)
     )
 
 
@@ -345,7 +419,7 @@ async def download_output(
     media_type = "video/webm" if is_video else "image/png"
     filename = f"output.{output_ext}"
 
-    output_path = get_output_path(job_id, output_ext)
+    output_path = find_output_path(job_id, output_ext)
     if not output_path.exists():
         raise HTTPException(status_code=404, detail="Output file not found")
 
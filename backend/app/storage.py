@@ -1,20 +1,40 @@
 """Storage utilities for file management."""
 import re
-import uuid
+import secrets
+import unicodedata
+from functools import lru_cache
 from pathlib import Path
 from typing import Optional
 
+from .models import AssetType
 from .settings import ASSETS_DIR, OUTPUTS_DIR, PREVIEWS_DIR, LOGS_DIR
 
 
+# Canonical UUID4 form: version nibble 4, RFC 4122 variant, either case
+_UUID4_RE = re.compile(
+    r"[0-9a-f]{8}-[0-9a-f]{4}-4[0-9a-f]{3}-[89ab][0-9a-f]{3}-[0-9a-f]{12}",
+    re.IGNORECASE,
+)
+
+
 class InvalidIdError(ValueError):
     """Raised when an ID fails validation."""
     pass
 
 
 def generate_id() -> str:
-    """Generate a unique ID."""
-    return str(uuid.uuid4())
+    """Generate a unique ID in UUID4 format."""
+    # Same layout as str(uuid.uuid4()) without building a UUID object:
+    # version nibble 4 and the RFC 4122 variant (8, 9, a or b)
+    h = secrets.token_hex(16)
+    variant = "89ab"[int(h[16], 16) & 3]
+    return f"{h[:8]}-{h[8:12]}-4{h[13:16]}-{variant}{h[17:20]}-{h[20:]}"
+
+
+@lru_cache(maxsize=4096)
+def _is_uuid4(id_value: str) -> bool:
+    """Memoized pattern check; IDs recur across a job's status polls."""
+    return _UUID4_RE.fullmatch(id_value) is not None
 
 
 def validate_id(id_value: str) -> str:
@@ -31,19 +51,51 @@ def validate_id(id_value: str) -> str:
     Raises:
         InvalidIdError: If the ID is not a valid UUID
     """
-    try:
-        parsed = uuid.UUID(id_value, version=4)
-        if str(parsed) != id_value.lower():
-            raise InvalidIdError(f"Invalid ID format: {id_value}")
-        return id_value
-    except ValueError:
+    # The length check keeps arbitrarily long rejected inputs out of the cache
+    if len(id_value) != 36 or not _is_uuid4(id_value):
         raise InvalidIdError(f"Invalid ID format: {id_value}")
+    return id_value
+
+
+class _SafeFilenameTable(dict):
+    """str.translate table keeping word characters, dash and dot.
+
+    Matches the regex class [\\w\\-.] for any code point. ASCII entries are
+    filled in up front; other code points are decided on lookup and not
+    stored, so unusual filenames cannot grow the table.
+    """
+
+    def __missing__(self, codepoint: int) -> int:
+        char = chr(codepoint)
+        return codepoint if char.isalnum() or char in "_-." else ord("_")
+
+
+_SAFE_FILENAME_TABLE = _SafeFilenameTable()
+_SAFE_FILENAME_TABLE.update({cp: _SAFE_FILENAME_TABLE[cp] for cp in range(128)})
+
+
+def _fold_accents(filename: str) -> str:
+    """Reduce accented Latin letters to their ASCII base letter.
+
+    Combining marks are dropped only after an ASCII base, so "café" becomes
+    "cafe" while marks that carry meaning elsewhere (e.g. Japanese dakuten)
+    are kept and recomposed. NFKD also maps full-width and other
+    compatibility forms to their plain equivalents.
+    """
+    folded: list[str] = []
+    for char in unicodedata.normalize("NFKD", filename):
+        if folded and unicodedata.combining(char) and folded[-1].isascii():
+            continue
+        folded.append(char)
+    return unicodedata.normalize("NFC", "".join(folded))
 
 
 def safe_filename(filename: str) -> str:
     """Sanitize filename to be safe for filesystem."""
+    if not filename.isascii():
+        filename = _fold_accents(filename)
     # Keep only alphanumeric, dash, underscore, dot
-    name = re.sub(r"[^\w\-.]", "_", filename)
+    name = filename.translate(_SAFE_FILENAME_TABLE)
     # Prevent hidden files
     name = name.lstrip(".")
     # Limit length
@@ -54,27 +106,45 @@ def safe_filename(filename: str) -> str:
 
 def get_extension(filename: str) -> str:
     """Get file extension from filename."""
-    return Path(filename).suffix.lower()
+    # Same result as Path(filename).suffix.lower() without building a Path
+    name = filename[filename.rfind("/") + 1:]
+    dot = name.rfind(".")
+    if dot <= 0 or dot == len(name) - 1:
+        return ""
+    return name[dot:].lower()
 
 
 # Valid file extensions
-VIDEO_EXTENSIONS = {".mp4", ".mov", ".avi", ".mkv", ".webm", ".m4v"}
-IMAGE_EXTENSIONS = {".png", ".jpg", ".jpeg", ".bmp", ".webp", ".gif"}
+VIDEO_EXTENSIONS = frozenset({".mp4", ".mov", ".avi", ".mkv", ".webm", ".m4v"})
+IMAGE_EXTENSIONS = frozenset({".png", ".jpg", ".jpeg", ".bmp", ".webp", ".gif"})
+VALID_EXTENSIONS = VIDEO_EXTENSIONS | IMAGE_EXTENSIONS
 
+_EXTENSION_TYPES = {
+    **{extension: AssetType.VIDEO for extension in VIDEO_EXTENSIONS},
+    **{extension: AssetType.IMAGE for extension in IMAGE_EXTENSIONS},
+}
 
+
+# get_extension() already lowercases, so the predicates try the
+# extension as given before paying for a lowercased copy
 def is_video_extension(extension: str) -> bool:
     """Check if extension is a video format."""
-    return extension.lower() in VIDEO_EXTENSIONS
+    return extension in VIDEO_EXTENSIONS or extension.lower() in VIDEO_EXTENSIONS
 
 
 def is_image_extension(extension: str) -> bool:
     """Check if extension is an image format."""
-    return extension.lower() in IMAGE_EXTENSIONS
+    return extension in IMAGE_EXTENSIONS or extension.lower() in IMAGE_EXTENSIONS
+
 
+def get_asset_type(extension: str) -> Optional[AssetType]:
+    """Get the asset type for an extension, or None if it is not supported."""
+    return _EXTENSION_TYPES.get(extension) or _EXTENSION_TYPES.get(extension.lower())
 
-def get_valid_extensions() -> set[str]:
+
+def get_valid_extensions() -> frozenset[str]:
     """Get all valid file extensions."""
-    return VIDEO_EXTENSIONS | IMAGE_EXTENSIONS
+    return VALID_EXTENSIONS
 
 
 def get_asset_dir(asset_id: str) -> Path:
@@ -85,19 +155,36 @@ def get_asset_dir(asset_id: str) -> Path:
     return path
 
 
+# Known asset input paths, so lookups don't have to scan the asset directory
+_asset_paths: dict[str, Path] = {}
+
+
 def get_asset_path(asset_id: str, extension: str) -> Path:
     """Get path for asset input file."""
-    return get_asset_dir(asset_id) / f"input{extension}"
+    path = get_asset_dir(asset_id) / f"input{extension}"
+    _asset_paths[asset_id] = path
+    return path
+
+
+def forget_asset_path(asset_id: str) -> None:
+    """Drop the known input path for an asset whose file was removed."""
+    _asset_paths.pop(asset_id, None)
 
 
 def find_asset_path(asset_id: str) -> Optional[Path]:
     """Find the input file for an asset."""
     validate_id(asset_id)
+    path = _asset_paths.get(asset_id)
+    if path is not None and path.is_file():
+        return path
+
+    # Not seen by this process (e.g. uploaded before a restart)
     asset_dir = ASSETS_DIR / asset_id
     if not asset_dir.exists():
         return None
     for f in asset_dir.iterdir():
         if f.name.startswith("input"):
+            _asset_paths[asset_id] = f
             return f
     return None
 
@@ -115,6 +202,15 @@ def get_output_path(job_id: str, extension: str = "webm") -> Path:
     return get_output_dir(job_id) / f"out.{extension}"
 
 
+def find_output_path(job_id: str, extension: str = "webm") -> Path:
+    """Get path for an existing output file without creating its directory.
+
+    For the status and download endpoints, which only read outputs.
+    """
+    validate_id(job_id)
+    return OUTPUTS_DIR / job_id / f"out.{extension}"
+
+
 def get_preview_dir(preview_id: str) -> Path:
     """Get directory for preview."""
     validate_id(preview_id)
@@ -7,7 +7,8 @@ import pytest
 from fastapi.testclient import TestClient
 
 from app.main import app
-from app.jobs import set_job_manager, JobManager
+from app.jobs import set_job_manager, Job, JobManager
+from app.models import AssetType
 
 
 @pytest.fixture
@@ -17,9 +18,18 @@ def temp_dir():
         yield Path(tmpdir)
 
 
-@pytest.fixture
+@pytest.fixture(scope="session")
+def shared_tmp(tmp_path_factory):
+    """Session-wide temp directory for tests that only build paths in it.
+
+    Tests that create or modify files should use temp_dir instead.
+    """
+    return tmp_path_factory.mktemp("shared")
+
+
+@pytest.fixture(scope="session")
 def client():
-    """Create a test client for the FastAPI app."""
+    """Create a test client for the FastAPI app, shared by the whole session."""
     with TestClient(app) as c:
         yield c
 
@@ -45,3 +55,44 @@ def job_manager():
     set_job_manager(manager)
     yield manager
     set_job_manager(None)
+
+
+class FakeProcess:
+    """Stand-in for a running ffmpeg Popen that counts termination calls."""
+
+    def __init__(self):
+        self.terminate_calls = 0
+        self.kill_calls = 0
+
+    def terminate(self):
+        self.terminate_calls += 1
+
+    def kill(self):
+        self.kill_calls += 1
+
+    def wait(self, timeout=None):
+        return 0
+
+
+@pytest.fixture
+def fake_process():
+    """Create a FakeProcess for jobs that need a running process."""
+    return FakeProcess()
+
+
+@pytest.fixture
+def make_job():
+    """Build Jobs with test defaults; pass only the fields a test cares about."""
+    def _make_job(**overrides):
+        fields = {
+            "job_id": "test-id",
+            "asset_id": "asset-123",
+            "input_path": Path("/test/input.mp4"),
+            "asset_type": AssetType.VIDEO,
+            "hex_color": "00FF00",
+            "similarity": 0.4,
+            "blend": 0.1,
+        }
+        fields.update(overrides)
+        return Job(**fields)
+    return _make_job
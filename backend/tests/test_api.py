@@ -1,30 +1,64 @@
 """Tests for API endpoints."""
-import io
 from pathlib import Path
 from unittest.mock import patch, MagicMock
 
 import pytest
-from fastapi.testclient import TestClient
 
+from app.ffmpeg_tools import ImageMetadata, VideoMetadata
 from app.main import app
-from app.jobs import set_job_manager, JobManager, Job
+from app.jobs import JobManager, get_job_manager
 from app.models import AssetType, JobStatus
+from app.storage import _asset_paths
 
+_FAKE_FILE = b"fake file content"
+_FAKE_MP4 = b"fake video content"
+_FAKE_PNG = b"fake image content"
 
-@pytest.fixture
-def client():
-    """Create a test client."""
-    with TestClient(app) as c:
-        yield c
+# Metadata is frozen, so one instance can be shared across tests
+_VIDEO_META = VideoMetadata(duration=10.5, width=1920, height=1080, fps=30.0, has_audio=True)
+_IMAGE_META = ImageMetadata(width=1920, height=1080)
+
+# Well-formed asset ID that is never uploaded
+_MISSING_ASSET_ID = "00000000-0000-4000-8000-000000000000"
+
+# Well-formed asset ID for uploads that are rejected
+_FAILED_ASSET_ID = "00000000-0000-4000-8000-000000000001"
+
+_ESTIMATE_URL = "/api/assets/test-asset-id/estimate-key"
+_PREVIEW_URL = "/api/assets/test-asset-id/preview"
+_RENDER_URL = "/api/assets/test-asset-id/render"
+_CHROMA_BODY = {"hex": "00FF00", "similarity": 0.4, "blend": 0.1}
+_PREVIEW_BODY = {**_CHROMA_BODY, "max_width": 640}
 
 
 @pytest.fixture
 def mock_job_manager():
-    """Create a mock JobManager."""
+    """Create a fresh JobManager injected into the endpoints."""
     manager = JobManager()
-    set_job_manager(manager)
+    app.dependency_overrides[get_job_manager] = lambda: manager
     yield manager
-    set_job_manager(None)
+    app.dependency_overrides.pop(get_job_manager, None)
+
+
+@pytest.fixture
+def populated_manager(mock_job_manager, make_job):
+    """Injected JobManager holding a "running" video job and a "done" image job.
+
+    Function-scoped because cancel tests mutate the jobs.
+    """
+    mock_job_manager._jobs["running"] = make_job(
+        job_id="running",
+        status=JobStatus.RUNNING,
+        progress=0.5
+    )
+    mock_job_manager._jobs["done"] = make_job(
+        job_id="done",
+        input_path=Path("/test/input.png"),
+        asset_type=AssetType.IMAGE,
+        status=JobStatus.DONE,
+        progress=1.0
+    )
+    return mock_job_manager
 
 
 class TestProbeEndpoint:
@@ -60,8 +94,7 @@ class TestUploadEndpoint:
 
     def test_upload_invalid_extension(self, client):
         """Upload should reject invalid file extensions."""
-        file_content = b"fake file content"
-        files = {"file": ("test.exe", io.BytesIO(file_content), "application/x-msdownload")}
+        files = {"file": ("test.exe", _FAKE_FILE, "application/x-msdownload")}
 
         response = client.post("/api/assets", files=files)
 
@@ -70,8 +103,7 @@ class TestUploadEndpoint:
 
     def test_upload_no_filename(self, client):
         """Upload should reject files without filename."""
-        file_content = b"fake file content"
-        files = {"file": ("", io.BytesIO(file_content), "video/mp4")}
+        files = {"file": ("", _FAKE_FILE, "video/mp4")}
 
         response = client.post("/api/assets", files=files)
 
@@ -80,21 +112,13 @@ class TestUploadEndpoint:
 
     def test_upload_valid_video(self, client, temp_dir):
         """Upload should accept valid video files."""
-        file_content = b"fake video content"
-
-        with patch("app.main.generate_id", return_value="test-asset-id"), \
-             patch("app.main.get_asset_path", return_value=temp_dir / "input.mp4"), \
-             patch("app.main.get_video_metadata") as mock_metadata:
-
-            mock_metadata.return_value = MagicMock(
-                width=1920,
-                height=1080,
-                duration=10.5,
-                fps=30.0,
-                has_audio=True
-            )
-
-            files = {"file": ("test.mp4", io.BytesIO(file_content), "video/mp4")}
+        with patch.multiple(
+            "app.main",
+            generate_id=MagicMock(return_value="test-asset-id"),
+            get_asset_path=MagicMock(return_value=temp_dir / "input.mp4"),
+            get_video_metadata=MagicMock(return_value=_VIDEO_META)
+        ):
+            files = {"file": ("test.mp4", _FAKE_MP4, "video/mp4")}
             response = client.post("/api/assets", files=files)
 
             assert response.status_code == 200
@@ -106,18 +130,13 @@ class TestUploadEndpoint:
 
     def test_upload_valid_image(self, client, temp_dir):
         """Upload should accept valid image files."""
-        file_content = b"fake image content"
-
-        with patch("app.main.generate_id", return_value="test-asset-id"), \
-             patch("app.main.get_asset_path", return_value=temp_dir / "input.png"), \
-             patch("app.main.get_image_metadata") as mock_metadata:
-
-            mock_metadata.return_value = MagicMock(
-                width=1920,
-                height=1080
-            )
-
-            files = {"file": ("test.png", io.BytesIO(file_content), "image/png")}
+        with patch.multiple(
+            "app.main",
+            generate_id=MagicMock(return_value="test-asset-id"),
+            get_asset_path=MagicMock(return_value=temp_dir / "input.png"),
+            get_image_metadata=MagicMock(return_value=_IMAGE_META)
+        ):
+            files = {"file": ("test.png", _FAKE_PNG, "image/png")}
             response = client.post("/api/assets", files=files)
 
             assert response.status_code == 200
@@ -126,31 +145,51 @@ class TestUploadEndpoint:
             assert data["asset_type"] == "image"
             assert data["duration"] is None
 
+    def test_upload_too_large_leaves_no_cached_path(self, client, mock_storage_dirs):
+        """A rejected oversize upload should not leave its path cached."""
+        with patch("app.main.generate_id", return_value=_FAILED_ASSET_ID), \
+             patch("app.main.MAX_UPLOAD_SIZE", 4):
+            files = {"file": ("test.mp4", _FAKE_MP4, "video/mp4")}
+            response = client.post("/api/assets", files=files)
+
+        assert response.status_code == 413
+        assert _FAILED_ASSET_ID not in _asset_paths
+        assert not (mock_storage_dirs / "assets" / _FAILED_ASSET_ID / "input.mp4").exists()
+
+    def test_upload_bad_metadata_leaves_no_cached_path(self, client, mock_storage_dirs):
+        """An upload that fails probing should not leave its path cached."""
+        with patch("app.main.generate_id", return_value=_FAILED_ASSET_ID), \
+             patch("app.main.get_video_metadata", side_effect=RuntimeError("bad")):
+            files = {"file": ("test.mp4", _FAKE_MP4, "video/mp4")}
+            response = client.post("/api/assets", files=files)
+
+        assert response.status_code == 400
+        assert _FAILED_ASSET_ID not in _asset_paths
+        assert not (mock_storage_dirs / "assets" / _FAILED_ASSET_ID / "input.mp4").exists()
+
 
 class TestEstimateKeyEndpoint:
     """Tests for /api/assets/{asset_id}/estimate-key endpoint."""
 
-    def test_estimate_key_not_found(self, client):
+    def test_estimate_key_not_found(self, client, mock_storage_dirs):
         """Estimate key should return 404 for missing asset."""
-        with patch("app.main.find_asset_path", return_value=None):
-            response = client.post("/api/assets/nonexistent-id/estimate-key")
-            assert response.status_code == 404
+        response = client.post(f"/api/assets/{_MISSING_ASSET_ID}/estimate-key")
+        assert response.status_code == 404
 
-    def test_estimate_key_success(self, client, temp_dir):
+    def test_estimate_key_success(self, client, shared_tmp):
         """Estimate key should return color estimation."""
-        input_path = temp_dir / "input.mp4"
-        input_path.touch()
-
-        with patch("app.main.find_asset_path", return_value=input_path), \
-             patch("app.main.get_extension", return_value=".mp4"), \
-             patch("app.main.is_video_extension", return_value=True), \
-             patch("app.main.get_video_metadata") as mock_meta, \
-             patch("app.main.estimate_background_color") as mock_estimate:
+        input_path = shared_tmp / "input.mp4"
 
-            mock_meta.return_value = MagicMock(duration=10.0)
-            mock_estimate.return_value = ("00FF00", (0, 255, 0), 12)
+        with patch.multiple(
+            "app.main",
+            find_asset_path=MagicMock(return_value=input_path),
+            get_extension=MagicMock(return_value=".mp4"),
+            is_video_extension=MagicMock(return_value=True),
+            get_video_metadata=MagicMock(return_value=_VIDEO_META),
+            estimate_background_color=MagicMock(return_value=("00FF00", (0, 255, 0), 12))
+        ):
 
-            response = client.post("/api/assets/test-asset-id/estimate-key")
+            response = client.post(_ESTIMATE_URL)
 
             assert response.status_code == 200
             data = response.json()
@@ -164,53 +203,100 @@ class TestEstimateKeyEndpoint:
 class TestPreviewEndpoint:
     """Tests for /api/assets/{asset_id}/preview endpoint."""
 
-    def test_preview_not_found(self, client):
+    def test_preview_not_found(self, client, mock_storage_dirs):
         """Preview should return 404 for missing asset."""
-        with patch("app.main.find_asset_path", return_value=None):
-            response = client.post(
-                "/api/assets/nonexistent-id/preview",
-                json={"hex": "00FF00", "similarity": 0.4, "blend": 0.1, "max_width": 640}
-            )
-            assert response.status_code == 404
+        response = client.post(
+            f"/api/assets/{_MISSING_ASSET_ID}/preview",
+            json=_PREVIEW_BODY
+        )
+        assert response.status_code == 404
 
-    def test_preview_invalid_hex(self, client, temp_dir):
+    def test_preview_invalid_hex(self, client, shared_tmp):
         """Preview should reject invalid hex color."""
-        input_path = temp_dir / "input.mp4"
-        input_path.touch()
+        input_path = shared_tmp / "input.mp4"
 
         with patch("app.main.find_asset_path", return_value=input_path):
             response = client.post(
-                "/api/assets/test-asset-id/preview",
-                json={"hex": "GGHHII", "similarity": 0.4, "blend": 0.1, "max_width": 640}
+                _PREVIEW_URL,
+                json={**_PREVIEW_BODY, "hex": "GGHHII"}
             )
             assert response.status_code == 422  # Validation error
 
+    def test_preview_returns_png(self, client, temp_dir):
+        """Preview should return the generated PNG with its preview ID."""
+        input_path = temp_dir / "input.png"
+        preview_path = temp_dir / "preview.png"
+
+        def fake_preview(output_path, **kwargs):
+            output_path.write_bytes(b"\x89PNG preview")
+
+        with patch.dict("app.main._preview_cache", clear=True), \
+             patch("app.main.find_asset_path", return_value=input_path), \
+             patch("app.main.get_preview_path", return_value=preview_path), \
+             patch("app.main.generate_preview", side_effect=fake_preview):
+            response = client.post(
+                _PREVIEW_URL,
+                json=_PREVIEW_BODY
+            )
+
+            assert response.status_code == 200
+            assert response.headers["content-type"] == "image/png"
+            assert "x-preview-id" in response.headers
+            assert response.content == b"\x89PNG preview"
+
+    def test_preview_reuses_identical_request(self, client, temp_dir):
+        """Repeated parameters should reuse the preview and honor If-None-Match."""
+        input_path = temp_dir / "input.png"
+        body = {**_PREVIEW_BODY, "hex": "00ff00"}
+
+        def fake_preview(output_path, **kwargs):
+            output_path.write_bytes(b"\x89PNG preview")
+
+        with patch.dict("app.main._preview_cache", clear=True), \
+             patch("app.main.find_asset_path", return_value=input_path), \
+             patch("app.main.get_preview_path", return_value=temp_dir / "preview.png"), \
+             patch("app.main.generate_preview", side_effect=fake_preview) as mock_preview:
+            first = client.post(_PREVIEW_URL, json=body)
+            second = client.post(_PREVIEW_URL, json={**body, "hex": "00FF00"})
+            not_modified = client.post(
+                _PREVIEW_URL,
+                json=body,
+                headers={"If-None-Match": first.headers["etag"]}
+            )
+
+            assert mock_preview.call_count == 1
+            assert second.status_code == 200
+            assert second.content == b"\x89PNG preview"
+            assert second.headers["etag"] == first.headers["etag"]
+            assert second.headers["x-preview-id"] == first.headers["x-preview-id"]
+            assert not_modified.status_code == 304
+
 
 class TestRenderEndpoint:
     """Tests for /api/assets/{asset_id}/render endpoint."""
 
-    def test_render_not_found(self, client, mock_job_manager):
+    def test_render_not_found(self, client, mock_job_manager, mock_storage_dirs):
         """Render should return 404 for missing asset."""
-        with patch("app.main.find_asset_path", return_value=None):
-            response = client.post(
-                "/api/assets/nonexistent-id/render",
-                json={"hex": "00FF00", "similarity": 0.4, "blend": 0.1}
-            )
-            assert response.status_code == 404
+        response = client.post(
+            f"/api/assets/{_MISSING_ASSET_ID}/render",
+            json=_CHROMA_BODY
+        )
+        assert response.status_code == 404
 
-    def test_render_starts_job(self, client, mock_job_manager, temp_dir):
+    def test_render_starts_job(self, client, mock_job_manager, shared_tmp):
         """Render should start a job and return job ID."""
-        input_path = temp_dir / "input.mp4"
-        input_path.touch()
+        input_path = shared_tmp / "input.mp4"
 
-        with patch("app.main.find_asset_path", return_value=input_path), \
-             patch("app.main.get_extension", return_value=".mp4"), \
-             patch("app.main.is_video_extension", return_value=True), \
-             patch.object(mock_job_manager, "create_job", return_value="test-job-id"):
+        with patch.multiple(
+            "app.main",
+            find_asset_path=MagicMock(return_value=input_path),
+            get_extension=MagicMock(return_value=".mp4"),
+            is_video_extension=MagicMock(return_value=True)
+        ), patch.object(mock_job_manager, "create_job", return_value="test-job-id"):
 
             response = client.post(
-                "/api/assets/test-asset-id/render",
-                json={"hex": "00FF00", "similarity": 0.4, "blend": 0.1}
+                _RENDER_URL,
+                json=_CHROMA_BODY
             )
 
             assert response.status_code == 200
@@ -226,34 +312,31 @@ class TestJobStatusEndpoint:
         response = client.get("/api/jobs/nonexistent-id")
         assert response.status_code == 404
 
-    def test_job_status_success(self, client, mock_job_manager, temp_dir):
+    def test_job_status_success(self, client, populated_manager, shared_tmp):
         """Job status should return job information."""
-        # Add a job to the manager
-        job = Job(
-            job_id="test-job-id",
-            asset_id="asset-123",
-            input_path=temp_dir / "input.mp4",
-            asset_type=AssetType.VIDEO,
-            hex_color="00FF00",
-            similarity=0.4,
-            blend=0.1,
-            status=JobStatus.RUNNING,
-            progress=0.5
-        )
-        mock_job_manager._jobs["test-job-id"] = job
-
-        with patch("app.main.get_output_path") as mock_output:
-            mock_path = MagicMock()
-            mock_path.exists.return_value = False
-            mock_output.return_value = mock_path
-
-            response = client.get("/api/jobs/test-job-id")
+        with patch("app.main.find_output_path", return_value=shared_tmp / "nope.webm") as mock_output:
+            response = client.get("/api/jobs/running")
 
             assert response.status_code == 200
             data = response.json()
-            assert data["job_id"] == "test-job-id"
+            assert data["job_id"] == "running"
             assert data["status"] == "running"
             assert data["progress"] == 0.5
+            assert data["output_filename"] is None
+            mock_output.assert_not_called()
+
+    def test_job_status_done_reports_output(self, client, populated_manager, temp_dir):
+        """A finished job should report its output file and size."""
+        output_path = temp_dir / "out.png"
+        output_path.write_bytes(b"png data")
+
+        with patch("app.main.find_output_path", return_value=output_path):
+            response = client.get("/api/jobs/done")
+
+            assert response.status_code == 200
+            data = response.json()
+            assert data["output_filename"] == "out.png"
+            assert data["output_size_bytes"] == 8
 
 
 class TestCancelJobEndpoint:
@@ -264,21 +347,9 @@ class TestCancelJobEndpoint:
         response = client.post("/api/jobs/nonexistent-id/cancel")
         assert response.status_code == 404
 
-    def test_cancel_job_success(self, client, mock_job_manager, temp_dir):
+    def test_cancel_job_success(self, client, populated_manager):
         """Cancel should cancel a running job."""
-        job = Job(
-            job_id="test-job-id",
-            asset_id="asset-123",
-            input_path=temp_dir / "input.mp4",
-            asset_type=AssetType.VIDEO,
-            hex_color="00FF00",
-            similarity=0.4,
-            blend=0.1,
-            status=JobStatus.RUNNING
-        )
-        mock_job_manager._jobs["test-job-id"] = job
-
-        response = client.post("/api/jobs/test-job-id/cancel")
+        response = client.post("/api/jobs/running/cancel")
 
         assert response.status_code == 200
         data = response.json()
@@ -293,21 +364,9 @@ class TestDownloadEndpoint:
         response = client.get("/api/jobs/nonexistent-id/download")
         assert response.status_code == 404
 
-    def test_download_not_complete(self, client, mock_job_manager, temp_dir):
+    def test_download_not_complete(self, client, populated_manager):
         """Download should return 400 for incomplete job."""
-        job = Job(
-            job_id="test-job-id",
-            asset_id="asset-123",
-            input_path=temp_dir / "input.mp4",
-            asset_type=AssetType.VIDEO,
-            hex_color="00FF00",
-            similarity=0.4,
-            blend=0.1,
-            status=JobStatus.RUNNING
-        )
-        mock_job_manager._jobs["test-job-id"] = job
-
-        response = client.get("/api/jobs/test-job-id/download")
+        response = client.get("/api/jobs/running/download")
 
         assert response.status_code == 400
         assert "not complete" in response.json()["detail"]
@@ -1,10 +1,27 @@
 """Tests for ffmpeg_tools module."""
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from unittest.mock import patch, MagicMock
+
 import pytest
 
 from app.ffmpeg_tools import (
     validate_hex_color,
     validate_chromakey_params,
     parse_progress,
+    build_corner_sample_command,
+    build_render_command,
+    build_image_render_command,
+    build_image_batch_render_command,
+    check_ffmpeg,
+    estimate_background_color,
+    sample_corner_colors,
+    CORNER_SIZE,
+    get_video_metadata,
+    _probe_locks,
     InvalidParameterError,
 )
 
@@ -12,98 +29,61 @@ from app.ffmpeg_tools import (
 class TestValidateHexColor:
     """Tests for validate_hex_color function."""
 
-    def test_valid_hex_color(self):
-        """Valid hex colors should be accepted."""
-        assert validate_hex_color("00FF00") == "00FF00"
-        assert validate_hex_color("ff0000") == "FF0000"
-        assert validate_hex_color("AABBCC") == "AABBCC"
-
-    def test_valid_hex_color_with_hash(self):
-        """Hex colors with # prefix should be accepted."""
-        assert validate_hex_color("#00FF00") == "00FF00"
-        assert validate_hex_color("#ff0000") == "FF0000"
+    @pytest.mark.parametrize("raw, expected", [
+        ("00FF00", "00FF00"),
+        ("ff0000", "FF0000"),
+        ("AABBCC", "AABBCC"),
+        ("#00FF00", "00FF00"),
+        ("#ff0000", "FF0000"),
+    ])
+    def test_valid_hex_color(self, raw, expected):
+        """Valid hex colors, with or without #, should be normalized."""
+        assert validate_hex_color(raw) == expected
 
-    def test_invalid_hex_color_short(self):
-        """Short hex colors should be rejected."""
+    @pytest.mark.parametrize("raw", [
+        "00FF",  # too short
+        "00FF00FF",  # too long
+        "GGHHII",  # not hex
+        "",
+        "#",
+        "00FF00\n",  # must not slip into the filter string
+    ])
+    def test_invalid_hex_color(self, raw):
+        """Malformed hex colors should be rejected."""
         with pytest.raises(InvalidParameterError) as exc_info:
-            validate_hex_color("00FF")
+            validate_hex_color(raw)
         assert "Invalid hex color format" in str(exc_info.value)
 
-    def test_invalid_hex_color_long(self):
-        """Long hex colors should be rejected."""
-        with pytest.raises(InvalidParameterError):
-            validate_hex_color("00FF00FF")
-
-    def test_invalid_hex_color_characters(self):
-        """Invalid characters should be rejected."""
-        with pytest.raises(InvalidParameterError):
-            validate_hex_color("GGHHII")
-
-    def test_empty_hex_color(self):
-        """Empty string should be rejected."""
-        with pytest.raises(InvalidParameterError):
-            validate_hex_color("")
-
-    def test_only_hash(self):
-        """Only # should be rejected."""
-        with pytest.raises(InvalidParameterError):
-            validate_hex_color("#")
-
 
 class TestValidateChromakeyParams:
     """Tests for validate_chromakey_params function."""
 
-    def test_valid_params(self):
-        """Valid parameters should be accepted."""
-        sim, blend = validate_chromakey_params(0.4, 0.1)
-        assert sim == 0.4
-        assert blend == 0.1
-
-    def test_boundary_values(self):
-        """Boundary values should be accepted."""
-        assert validate_chromakey_params(0.0, 0.0) == (0.0, 0.0)
-        assert validate_chromakey_params(1.0, 1.0) == (1.0, 1.0)
-        assert validate_chromakey_params(0.5, 0.5) == (0.5, 0.5)
-
-    def test_integer_values(self):
-        """Integer values should be converted to float."""
-        sim, blend = validate_chromakey_params(0, 1)
-        assert sim == 0.0
-        assert blend == 1.0
-        assert isinstance(sim, float)
-        assert isinstance(blend, float)
-
-    def test_similarity_too_low(self):
-        """Similarity below 0 should be rejected."""
-        with pytest.raises(InvalidParameterError) as exc_info:
-            validate_chromakey_params(-0.1, 0.1)
-        assert "similarity" in str(exc_info.value).lower()
-
-    def test_similarity_too_high(self):
-        """Similarity above 1 should be rejected."""
-        with pytest.raises(InvalidParameterError):
-            validate_chromakey_params(1.1, 0.1)
+    @pytest.mark.parametrize("similarity, blend", [
+        (0.4, 0.1),
+        (0.0, 0.0),
+        (1.0, 1.0),
+        (0.5, 0.5),
+        (0, 1),  # integers are converted to float
+    ])
+    def test_valid_params(self, similarity, blend):
+        """Values within 0.0-1.0 should be returned as floats."""
+        result = validate_chromakey_params(similarity, blend)
+        assert result == (similarity, blend)
+        assert all(isinstance(value, float) for value in result)
 
-    def test_blend_too_low(self):
-        """Blend below 0 should be rejected."""
+    @pytest.mark.parametrize("similarity, blend, name", [
+        (-0.1, 0.1, "similarity"),
+        (1.1, 0.1, "similarity"),
+        ("0.4", 0.1, "similarity"),
+        (0.4, -0.1, "blend"),
+        (0.4, 1.1, "blend"),
+        (0.4, "0.1", "blend"),
+    ])
+    def test_invalid_params(self, similarity, blend, name):
+        """Out-of-range or non-numeric values should be rejected."""
         with pytest.raises(InvalidParameterError) as exc_info:
-            validate_chromakey_params(0.4, -0.1)
-        assert "blend" in str(exc_info.value).lower()
-
-    def test_blend_too_high(self):
-        """Blend above 1 should be rejected."""
-        with pytest.raises(InvalidParameterError):
-            validate_chromakey_params(0.4, 1.1)
-
-    def test_non_numeric_similarity(self):
-        """Non-numeric similarity should be rejected."""
-        with pytest.raises(InvalidParameterError):
-            validate_chromakey_params("0.4", 0.1)
-
-    def test_non_numeric_blend(self):
-        """Non-numeric blend should be rejected."""
-        with pytest.raises(InvalidParameterError):
-            validate_chromakey_params(0.4, "0.1")
+            validate_chromakey_params(similarity, blend)
+        assert name in str(exc_info.value).lower()
 
 
 class TestParseProgress:
@@ -111,27 +91,399 @@ class TestParseProgress:
 
     def test_valid_progress_line(self):
         """Valid progress line should be parsed."""
-        assert parse_progress("out_time_ms=1000000") == 1000000
-        assert parse_progress("out_time_ms=0") == 0
-        assert parse_progress("out_time_ms=5000") == 5000
+        assert parse_progress(b"out_time_ms=1000000") == 1000000
+        assert parse_progress(b"out_time_ms=0") == 0
+        assert parse_progress(b"out_time_ms=5000") == 5000
 
     def test_non_progress_line(self):
         """Non-progress lines should return None."""
-        assert parse_progress("frame=100") is None
-        assert parse_progress("fps=30") is None
-        assert parse_progress("progress=continue") is None
+        assert parse_progress(b"frame=100") is None
+        assert parse_progress(b"fps=30") is None
+        assert parse_progress(b"progress=continue") is None
 
     def test_malformed_progress_line(self):
         """Malformed progress lines should return None."""
-        assert parse_progress("out_time_ms=") is None
-        assert parse_progress("out_time_ms=abc") is None
-        assert parse_progress("out_time_ms") is None
+        assert parse_progress(b"out_time_ms=") is None
+        assert parse_progress(b"out_time_ms=abc") is None
+        assert parse_progress(b"out_time_ms") is None
 
     def test_empty_line(self):
         """Empty line should return None."""
-        assert parse_progress("") is None
+        assert parse_progress(b"") is None
 
     def test_progress_with_whitespace(self):
-        """Progress line with surrounding whitespace."""
-        # The function expects clean lines
-        assert parse_progress("out_time_ms=1000") == 1000
+        """Progress line with trailing newline, as read from the pipe."""
+        assert parse_progress(b"out_time_ms=1000\n") == 1000
+        assert parse_progress(b"out_time_ms=1000\r\n") == 1000
+
+
+class TestCheckFFmpeg:
+    """Tests for check_ffmpeg function."""
+
+    def _fake_process(self, stdout, returncode=0):
+        process = MagicMock()
+        process.communicate.return_value = (stdout, None)
+        process.returncode = returncode
+        process.poll.return_value = returncode
+        return process
+
+    def test_tools_missing(self):
+        """Should report failure without spawning anything."""
+        with patch("app.ffmpeg_tools.shutil.which", return_value=None), \
+             patch("app.ffmpeg_tools.subprocess.Popen") as mock_popen:
+            assert check_ffmpeg() == (False, None, None)
+        mock_popen.assert_not_called()
+
+    def test_starts_both_checks_before_waiting(self):
+        """Both version checks should be started before either is awaited."""
+        events = []
+
+        def popen(cmd, **kwargs):
+            tool = Path(cmd[0]).name
+            events.append(f"start {tool}")
+            process = self._fake_process(None)
+
+            def communicate(timeout=None):
+                events.append(f"wait {tool}")
+                return f"{tool} version 6.0\nmore", None
+
+            process.communicate.side_effect = communicate
+            return process
+
+        with patch("app.ffmpeg_tools.shutil.which", side_effect=lambda name: f"/usr/bin/{name}"), \
+             patch("app.ffmpeg_tools.subprocess.Popen", side_effect=popen):
+            result = check_ffmpeg()
+
+        assert result == (True, "ffmpeg version 6.0", "ffprobe version 6.0")
+        assert events == ["start ffmpeg", "start ffprobe", "wait ffmpeg", "wait ffprobe"]
+
+    def test_timeout_kills_processes(self):
+        """A hung version check should be killed."""
+        ffmpeg = self._fake_process("ffmpeg version 6.0")
+        ffmpeg.communicate.side_effect = subprocess.TimeoutExpired("ffmpeg", 10)
+        ffmpeg.poll.return_value = None
+        ffprobe = self._fake_process("ffprobe version 6.0")
+        ffprobe.poll.return_value = None
+
+        with patch("app.ffmpeg_tools.shutil.which", return_value="/usr/bin/tool"), \
+             patch("app.ffmpeg_tools.subprocess.Popen", side_effect=[ffmpeg, ffprobe]):
+            assert check_ffmpeg() == (False, None, None)
+
+        ffmpeg.kill.assert_called_once()
+        ffprobe.kill.assert_called_once()
+
+
+class TestBuildCornerSampleCommand:
+    """Tests for build_corner_sample_command function."""
+
+    def test_image_single_input(self):
+        """Images should use one input without seeking."""
+        cmd = build_corner_sample_command(Path("/test/input.png"))
+        assert cmd.count("-i") == 1
+        assert "-ss" not in cmd
+        graph = cmd[cmd.index("-filter_complex") + 1]
+        assert "hstack=inputs=4[row0]" in graph
+        assert "vstack" not in graph
+        assert cmd[cmd.index("-map") + 1] == "[row0]"
+
+    def test_video_one_input_per_timestamp(self):
+        """Videos should seek once per timestamp and stack the rows."""
+        cmd = build_corner_sample_command(Path("/test/input.mp4"), [0.0, 0.5, 1.0])
+        assert cmd.count("-i") == 3
+        assert cmd.count("-ss") == 3
+        graph = cmd[cmd.index("-filter_complex") + 1]
+        assert "vstack=inputs=3[out]" in graph
+        assert cmd[cmd.index("-map") + 1] == "[out]"
+
+
+class TestBuildRenderCommand:
+    """Tests for build_render_command function."""
+
+    def _build(self, **kwargs):
+        return build_render_command(
+            input_path=Path("/test/input.mp4"),
+            output_path=Path("/out/out.webm"),
+            hex_color="00FF00",
+            similarity=0.1,
+            blend=0.05,
+            crf=24,
+            include_audio=True,
+            has_audio=True,
+            **kwargs
+        )
+
+    def test_default_threads(self):
+        """ffmpeg's own thread default should be kept unless requested."""
+        assert "-threads" not in self._build()
+
+    def test_filter_string(self):
+        """The chromakey filter should be normalized and end in yuva420p."""
+        cmd = self._build()
+        assert cmd[cmd.index("-vf") + 1] == "chromakey=0x00FF00:0.1:0.05,format=yuva420p"
+
+    def test_invalid_color_still_rejected(self):
+        """Cached filter building must not let invalid input through."""
+        for _ in range(2):
+            with pytest.raises(InvalidParameterError):
+                build_render_command(
+                    Path("/test/input.mp4"), Path("/out/out.webm"),
+                    "00FF00; rm -rf /", 0.1, 0.05, 24, False, False
+                )
+
+    def test_threads_cap(self):
+        """A thread cap should be passed to ffmpeg."""
+        cmd = self._build(threads=4)
+        assert cmd[cmd.index("-threads") + 1] == "4"
+        assert cmd[-1] == "/out/out.webm"
+
+
+class TestBuildImageRenderCommand:
+    """Tests for build_image_render_command function."""
+
+    def test_renders_single_frame(self):
+        """Only the first frame should be rendered (animated GIF/WebP)."""
+        cmd = build_image_render_command(
+            Path("/test/input.gif"), Path("/out/out.png"), "00FF00", 0.1, 0.05
+        )
+        assert cmd[cmd.index("-frames:v") + 1] == "1"
+        assert cmd[cmd.index("-update") + 1] == "1"
+        assert cmd[-1] == "/out/out.png"
+
+
+class TestBuildImageBatchRenderCommand:
+    """Tests for build_image_batch_render_command function."""
+
+    def test_one_output_per_input(self):
+        """Each input should get its own filter chain and output."""
+        cmd = build_image_batch_render_command([
+            (Path("/test/a.png"), Path("/out/a.png"), "00ff00", 0.1, 0.05),
+            (Path("/test/b.png"), Path("/out/b.png"), "0000FF", 0.2, 0.1),
+        ])
+        assert cmd.count("-i") == 2
+        graph = cmd[cmd.index("-filter_complex") + 1]
+        assert "[0:v]chromakey=0x00FF00:0.1:0.05,format=rgba[v0]" in graph
+        assert "[1:v]chromakey=0x0000FF:0.2:0.1,format=rgba[v1]" in graph
+        assert cmd[-9:] == [
+            "-map", "[v1]", "-frames:v", "1", "-update", "1", "-f", "image2", "/out/b.png"
+        ]
+
+    def test_invalid_color_rejected(self):
+        """Invalid parameters in any entry should be rejected."""
+        with pytest.raises(InvalidParameterError):
+            build_image_batch_render_command([
+                (Path("/test/a.png"), Path("/out/a.png"), "00FF00", 0.1, 0.05),
+                (Path("/test/b.png"), Path("/out/b.png"), "00FF00;rm", 0.1, 0.05),
+            ])
+
+
+def corner_frame(colors, rows):
+    """Build the stacked rgb24 frame the corner sampling command emits."""
+    per_row = len(colors) // rows
+    frame = b""
+    for i in range(rows):
+        row_colors = colors[i * per_row:(i + 1) * per_row]
+        line = b"".join(bytes(color) * CORNER_SIZE for color in row_colors)
+        frame += line * CORNER_SIZE
+    return frame
+
+
+class TestEstimateBackgroundColor:
+    """Tests for estimate_background_color function."""
+
+    def test_single_ffmpeg_call_for_video(self):
+        """All corners at all timestamps should come from one ffmpeg run."""
+        stdout = corner_frame([(0, 255, 0)] * 11 + [(255, 0, 0)], rows=3)
+        result = subprocess.CompletedProcess([], 0, stdout=stdout, stderr=b"")
+
+        with patch("app.ffmpeg_tools.subprocess.run", return_value=result) as mock_run:
+            hex_color, rgb, samples = estimate_background_color(Path("/test/input.mp4"), 10.0)
+
+        assert mock_run.call_count == 1
+        assert hex_color == "00FF00"
+        assert rgb == (0, 255, 0)
+        assert all(type(channel) is int for channel in rgb)
+        assert samples == 12
+
+    def test_median_of_even_sample_count(self):
+        """An even number of samples should average the middle pair."""
+        stdout = corner_frame([(0, 0, 0), (10, 100, 1), (21, 200, 2), (255, 255, 255)], rows=1)
+        result = subprocess.CompletedProcess([], 0, stdout=stdout, stderr=b"")
+
+        with patch("app.ffmpeg_tools.subprocess.run", return_value=result):
+            hex_color, rgb, samples = estimate_background_color(Path("/test/input.png"))
+
+        assert rgb == (15, 150, 1)
+        assert hex_color == "0F9601"
+        assert samples == 4
+
+    def test_averages_whole_corner_region(self):
+        """Each corner sample should be the mean of its region."""
+        frame = bytearray(corner_frame([(0, 0, 0)] * 4, rows=1))
+        # Make the top half of the top-left block white
+        row_stride = 4 * CORNER_SIZE * 3
+        for y in range(CORNER_SIZE // 2):
+            frame[y * row_stride:y * row_stride + CORNER_SIZE * 3] = b"\xff" * CORNER_SIZE * 3
+        result = subprocess.CompletedProcess([], 0, stdout=bytes(frame), stderr=b"")
+
+        with patch("app.ffmpeg_tools.subprocess.run", return_value=result):
+            assert sample_corner_colors(Path("/test/input.png")) == [
+                (128, 128, 128), (0, 0, 0), (0, 0, 0), (0, 0, 0)
+            ]
+
+    def test_short_output_is_rejected(self):
+        """Truncated ffmpeg output should not produce samples."""
+        result = subprocess.CompletedProcess([], 0, stdout=b"\x00" * 12, stderr=b"")
+
+        with patch("app.ffmpeg_tools.subprocess.run", return_value=result):
+            assert sample_corner_colors(Path("/test/input.png")) == []
+
+    def test_falls_back_to_per_region_sampling(self):
+        """A failed batch run should fall back to sampling each corner."""
+        failed = subprocess.CompletedProcess([], 1, stdout=b"", stderr=b"error")
+        single = subprocess.CompletedProcess([], 0, stdout=bytes([0, 0, 255]), stderr=b"")
+
+        with patch("app.ffmpeg_tools.subprocess.run", side_effect=[failed] + [single] * 4) as mock_run:
+            hex_color, rgb, samples = estimate_background_color(Path("/test/input.png"))
+
+        assert mock_run.call_count == 5
+        assert hex_color == "0000FF"
+        assert all(type(channel) is int for channel in rgb)
+        assert samples == 4
+
+    def test_no_samples_raises(self):
+        """Should raise when no colors could be sampled."""
+        failed = subprocess.CompletedProcess([], 1, stdout=b"", stderr=b"error")
+
+        with patch("app.ffmpeg_tools.subprocess.run", return_value=failed):
+            with pytest.raises(RuntimeError):
+                estimate_background_color(Path("/test/input.png"))
+
+
+class TestGetVideoMetadata:
+    """Tests for get_video_metadata function."""
+
+    FFPROBE_OUTPUT = (
+        "stream|codec_type=video|width=1920|height=1080|r_frame_rate=30/1|duration=N/A\n"
+        "stream|codec_type=audio|r_frame_rate=0/0|duration=10.496000\n"
+        "format|duration=10.500000\n"
+    )
+
+    def test_parses_metadata(self, temp_dir):
+        """Should parse ffprobe compact output."""
+        video_path = temp_dir / "input.mp4"
+        video_path.write_bytes(b"video")
+        result = subprocess.CompletedProcess([], 0, stdout=self.FFPROBE_OUTPUT, stderr="")
+
+        with patch("app.ffmpeg_tools.subprocess.run", return_value=result):
+            metadata = get_video_metadata(video_path)
+
+        assert metadata.width == 1920
+        assert metadata.height == 1080
+        assert metadata.duration == 10.5
+        assert metadata.fps == 30.0
+        assert metadata.has_audio is True
+
+    def test_falls_back_to_stream_duration(self, temp_dir):
+        """Stream duration should be used when the format has none."""
+        video_path = temp_dir / "input.webm"
+        video_path.write_bytes(b"video")
+        output = (
+            "stream|codec_type=video|width=640|height=480|r_frame_rate=25/1|duration=4.000000\n"
+            "format|duration=N/A\n"
+        )
+        result = subprocess.CompletedProcess([], 0, stdout=output, stderr="")
+
+        with patch("app.ffmpeg_tools.subprocess.run", return_value=result):
+            metadata = get_video_metadata(video_path)
+
+        assert metadata.duration == 4.0
+        assert metadata.fps == 25.0
+        assert metadata.has_audio is False
+
+    def test_no_video_stream(self, temp_dir):
+        """Files without a video stream should be rejected."""
+        audio_path = temp_dir / "input.mp4"
+        audio_path.write_bytes(b"audio")
+        output = "stream|codec_type=audio|r_frame_rate=0/0|duration=3.0\nformat|duration=3.0\n"
+        result = subprocess.CompletedProcess([], 0, stdout=output, stderr="")
+
+        with patch("app.ffmpeg_tools.subprocess.run", return_value=result):
+            with pytest.raises(RuntimeError):
+                get_video_metadata(audio_path)
+
+    def test_caches_unchanged_file(self, temp_dir):
+        """Probing an unchanged file twice should run ffprobe once."""
+        video_path = temp_dir / "input.mp4"
+        video_path.write_bytes(b"video")
+        result = subprocess.CompletedProcess([], 0, stdout=self.FFPROBE_OUTPUT, stderr="")
+
+        with patch("app.ffmpeg_tools.subprocess.run", return_value=result) as mock_run:
+            first = get_video_metadata(video_path)
+            second = get_video_metadata(video_path)
+
+        assert mock_run.call_count == 1
+        assert first == second
+
+    def test_concurrent_calls_share_one_probe(self, temp_dir):
+        """Concurrent first probes of the same file should run ffprobe once."""
+        video_path = temp_dir / "input.mp4"
+        video_path.write_bytes(b"video")
+        result = subprocess.CompletedProcess([], 0, stdout=self.FFPROBE_OUTPUT, stderr="")
+
+        def slow_run(cmd, **kwargs):
+            time.sleep(0.05)
+            return result
+
+        with patch("app.ffmpeg_tools.subprocess.run", side_effect=slow_run) as mock_run, \
+             ThreadPoolExecutor(max_workers=4) as executor:
+            results = list(executor.map(lambda _: get_video_metadata(video_path), range(4)))
+
+        assert mock_run.call_count == 1
+        assert all(metadata == results[0] for metadata in results)
+
+    def test_failed_probe_keeps_waiters_serialized(self, temp_dir):
+        """A failed probe should not let a later caller run beside a waiter."""
+        video_path = temp_dir / "input.mp4"
+        video_path.write_bytes(b"video")
+        failed = subprocess.CompletedProcess([], 1, stdout="", stderr="error")
+        active = 0
+        max_active = 0
+        counter_lock = threading.Lock()
+
+        def slow_failing_run(cmd, **kwargs):
+            nonlocal active, max_active
+            with counter_lock:
+                active += 1
+                max_active = max(max_active, active)
+            time.sleep(0.2)
+            with counter_lock:
+                active -= 1
+            return failed
+
+        def probe(delay):
+            time.sleep(delay)
+            with pytest.raises(Exception):
+                get_video_metadata(video_path)
+
+        # The third caller arrives after the first probe failed, while the
+        # second caller is probing again
+        with patch("app.ffmpeg_tools.subprocess.run", side_effect=slow_failing_run) as mock_run, \
+             ThreadPoolExecutor(max_workers=3) as executor:
+            list(executor.map(probe, [0, 0.05, 0.3]))
+
+        assert mock_run.call_count == 3
+        assert max_active == 1
+        assert _probe_locks == {}
+
+    def test_reprobes_modified_file(self, temp_dir):
+        """A file whose size changed should be probed again."""
+        video_path = temp_dir / "input.mp4"
+        video_path.write_bytes(b"video")
+        result = subprocess.CompletedProcess([], 0, stdout=self.FFPROBE_OUTPUT, stderr="")
+
+        with patch("app.ffmpeg_tools.subprocess.run", return_value=result) as mock_run:
+            get_video_metadata(video_path)
+            video_path.write_bytes(b"longer video")
+            get_video_metadata(video_path)
+
+        assert mock_run.call_count == 2
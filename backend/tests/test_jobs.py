@@ -1,33 +1,31 @@
 """Tests for jobs module."""
+import io
+import subprocess
+import sys
 import time
+from collections import deque
 from pathlib import Path
 from unittest.mock import patch, MagicMock
 import pytest
 
-from app.jobs import JobManager, Job, get_job_manager, set_job_manager
+from app.ffmpeg_tools import VideoMetadata
+from app.jobs import JobManager, Job, LOG_TAIL_LINES, get_job_manager, set_job_manager
 from app.models import AssetType, JobStatus
 
+_VIDEO_META = VideoMetadata(duration=20.0, width=1920, height=1080, fps=30.0, has_audio=False)
+
 
 class TestJobManager:
     """Tests for JobManager class."""
 
-    def test_create_job_returns_id(self, temp_dir):
-        """create_job should return a job ID."""
-        manager = JobManager()
-        input_path = temp_dir / "test.mp4"
-        input_path.touch()
-
-        with patch("app.jobs.generate_id", return_value="test-job-id"), \
-             patch("app.jobs.get_output_path", return_value=temp_dir / "output.webm"), \
-             patch("app.jobs.get_log_path", return_value=temp_dir / "log.txt"), \
-             patch("app.jobs.get_video_metadata") as mock_metadata, \
-             patch("app.jobs.build_render_command", return_value=["echo", "test"]), \
-             patch("threading.Thread") as mock_thread:
-
-            mock_metadata.return_value = MagicMock(duration=10.0, has_audio=True)
-            # Prevent background thread from actually running
-            mock_thread.return_value.start = MagicMock()
+    def test_create_job_returns_id(self, shared_tmp):
+        """create_job should return a job ID and queue the render."""
+        # Record submissions instead of running renders in the background
+        executor = MagicMock()
+        manager = JobManager(executor=executor)
+        input_path = shared_tmp / "test.mp4"
 
+        with patch("app.jobs.generate_id", return_value="test-job-id"):
             job_id = manager.create_job(
                 asset_id="asset-123",
                 input_path=input_path,
@@ -39,23 +37,36 @@ class TestJobManager:
                 include_audio=True
             )
 
-            assert job_id == "test-job-id"
-            mock_thread.assert_called_once()
+        assert job_id == "test-job-id"
+        executor.submit.assert_called_once_with(manager._run_render, "test-job-id")
+        assert manager.get_job("test-job-id").status == JobStatus.QUEUED
+
+    def test_image_jobs_use_image_worker(self, shared_tmp):
+        """Image batches should not queue behind video renders."""
+        executor = MagicMock()
+        image_executor = MagicMock()
+        manager = JobManager(executor=executor, image_executor=image_executor)
+
+        with patch("app.jobs.IMAGE_BATCH_WINDOW", 0):
+            manager.create_job(
+                asset_id="asset-123",
+                input_path=shared_tmp / "test.png",
+                asset_type=AssetType.IMAGE,
+                hex_color="00FF00",
+                similarity=0.4,
+                blend=0.1
+            )
+            manager._image_batch_timer.join()
+
+        image_executor.submit.assert_called_once_with(manager._run_image_batch)
+        executor.submit.assert_not_called()
 
-    def test_get_job_returns_job(self):
+    def test_get_job_returns_job(self, make_job):
         """get_job should return the job."""
         manager = JobManager()
 
         # Add a job directly
-        job = Job(
-            job_id="test-id",
-            asset_id="asset-123",
-            input_path=Path("/test/input.mp4"),
-            asset_type=AssetType.VIDEO,
-            hex_color="00FF00",
-            similarity=0.4,
-            blend=0.1
-        )
+        job = make_job()
         manager._jobs["test-id"] = job
 
         result = manager.get_job("test-id")
@@ -69,20 +80,27 @@ class TestJobManager:
         result = manager.get_job("nonexistent-id")
         assert result is None
 
-    def test_cancel_job_queued(self):
+    def test_get_job_snapshot_copies_fields(self, make_job):
+        """get_job_snapshot should return a copy detached from the live job."""
+        manager = JobManager()
+
+        job = make_job(log_lines=deque(["first"]))
+        manager._jobs["test-id"] = job
+
+        snapshot = manager.get_job_snapshot("test-id")
+        job.progress = 0.5
+        job.log_lines.append("second")
+
+        assert snapshot is not job
+        assert snapshot.progress == 0.0
+        assert list(snapshot.log_lines) == ["first"]
+        assert manager.get_job_snapshot("nonexistent-id") is None
+
+    def test_cancel_job_queued(self, make_job):
         """cancel_job should cancel a queued job."""
         manager = JobManager()
 
-        job = Job(
-            job_id="test-id",
-            asset_id="asset-123",
-            input_path=Path("/test/input.mp4"),
-            asset_type=AssetType.VIDEO,
-            hex_color="00FF00",
-            similarity=0.4,
-            blend=0.1,
-            status=JobStatus.QUEUED
-        )
+        job = make_job(status=JobStatus.QUEUED)
         manager._jobs["test-id"] = job
 
         result = manager.cancel_job("test-id")
@@ -90,45 +108,25 @@ class TestJobManager:
         assert job.status == JobStatus.CANCELED
         assert job.message == "Canceled by user"
         assert job.finished_at is not None
+        assert job.cancel_event.is_set()
 
-    def test_cancel_job_running(self):
+    def test_cancel_job_running(self, make_job, fake_process):
         """cancel_job should cancel a running job."""
         manager = JobManager()
 
-        mock_process = MagicMock()
-        mock_process.wait.return_value = None
-
-        job = Job(
-            job_id="test-id",
-            asset_id="asset-123",
-            input_path=Path("/test/input.mp4"),
-            asset_type=AssetType.VIDEO,
-            hex_color="00FF00",
-            similarity=0.4,
-            blend=0.1,
-            status=JobStatus.RUNNING,
-            process=mock_process
-        )
+        job = make_job(status=JobStatus.RUNNING, process=fake_process)
         manager._jobs["test-id"] = job
 
         result = manager.cancel_job("test-id")
         assert result is True
-        mock_process.terminate.assert_called_once()
+        assert fake_process.terminate_calls == 1
+        assert fake_process.kill_calls == 0
 
-    def test_cancel_job_already_done(self):
+    def test_cancel_job_already_done(self, make_job):
         """cancel_job should return False for completed job."""
         manager = JobManager()
 
-        job = Job(
-            job_id="test-id",
-            asset_id="asset-123",
-            input_path=Path("/test/input.mp4"),
-            asset_type=AssetType.VIDEO,
-            hex_color="00FF00",
-            similarity=0.4,
-            blend=0.1,
-            status=JobStatus.DONE
-        )
+        job = make_job(status=JobStatus.DONE)
         manager._jobs["test-id"] = job
 
         result = manager.cancel_job("test-id")
@@ -141,14 +139,205 @@ class TestJobManager:
         result = manager.cancel_job("nonexistent-id")
         assert result is False
 
+    def test_shutdown_cancels_pending_work(self, make_job, fake_process):
+        """shutdown should drop queued work and stop running processes."""
+        executor = MagicMock()
+        image_executor = MagicMock()
+        manager = JobManager(executor=executor, image_executor=image_executor)
+
+        manager._jobs["queued"] = make_job(job_id="queued")
+        manager._jobs["running"] = make_job(
+            job_id="running", status=JobStatus.RUNNING, process=fake_process
+        )
+        manager._jobs["done"] = make_job(job_id="done", status=JobStatus.DONE)
+
+        manager.shutdown()
+
+        executor.shutdown.assert_called_once_with(wait=False, cancel_futures=True)
+        image_executor.shutdown.assert_called_once_with(wait=False, cancel_futures=True)
+        assert fake_process.terminate_calls == 1
+        assert manager.get_job("queued").status == JobStatus.CANCELED
+        assert manager.get_job("running").status == JobStatus.CANCELED
+        assert manager.get_job("running").message == "Canceled by server shutdown"
+        assert manager.get_job("done").status == JobStatus.DONE
+
+    def test_run_render_skips_canceled_job(self, make_job):
+        """A job canceled while queued should not start rendering."""
+        manager = JobManager()
+
+        job = make_job(status=JobStatus.CANCELED)
+        manager._jobs["test-id"] = job
+
+        with patch("app.jobs.get_output_path") as mock_output:
+            manager._run_render("test-id")
+
+        mock_output.assert_not_called()
+        assert job.status == JobStatus.CANCELED
+        assert job.started_at is None
+
+    def test_run_render_video_progress_and_log_tail(self, temp_dir, make_job):
+        """Video render should track progress and keep the last log lines."""
+        manager = JobManager()
+        output_path = temp_dir / "out.webm"
+        output_path.touch()
+
+        job = make_job(input_path=temp_dir / "input.mp4", crf=24)
+        manager._jobs["test-id"] = job
+
+        progress_lines = b"".join(
+            f"out_time_ms={i * 1000000}\nprogress=continue\n".encode() for i in range(1, 11)
+        )
+        process = MagicMock()
+        process.stdout = io.BytesIO(progress_lines)
+        process.stderr = io.BytesIO(b"encoder warning\n")
+        process.returncode = 0
+
+        with patch("app.jobs.get_output_path", return_value=output_path), \
+             patch("app.jobs.get_log_path", return_value=temp_dir / "log.txt"), \
+             patch("app.jobs.get_video_metadata", return_value=_VIDEO_META), \
+             patch("app.jobs.subprocess.Popen", return_value=process):
+            manager._run_render("test-id")
+
+        assert job.status == JobStatus.DONE
+        assert job.progress == 1.0
+        assert len(job.log_lines) == 10
+        assert list(job.log_lines)[-3:] == ["", "--- STDERR ---", "encoder warning"]
+        assert (temp_dir / "log.txt").read_bytes().startswith(b"out_time_ms=1000000\n")
+
+
+    def test_run_render_throttles_progress(self, temp_dir, make_job):
+        """Progress should be updated at most once per interval."""
+        manager = JobManager()
+
+        job = make_job(input_path=temp_dir / "input.mp4", crf=24)
+        manager._jobs["test-id"] = job
+
+        progress_lines = b"".join(
+            f"out_time_ms={i * 1000}\nprogress=continue\n".encode() for i in range(1, 11)
+        )
+        process = MagicMock()
+        process.stdout = io.BytesIO(progress_lines)
+        process.stderr = io.BytesIO(b"")
+        process.returncode = 1
+
+        # Ten progress blocks a quarter second apart: updates at 0s, 1s and 2s
+        clock = iter([i * 0.25 for i in range(10)])
+
+        with patch("app.jobs.get_output_path", return_value=temp_dir / "out.webm"), \
+             patch("app.jobs.get_log_path", return_value=temp_dir / "log.txt"), \
+             patch("app.jobs.get_video_metadata", return_value=_VIDEO_META), \
+             patch("app.jobs.subprocess.Popen", return_value=process), \
+             patch("app.jobs.time.monotonic", side_effect=lambda: next(clock)):
+            manager._run_render("test-id")
+
+        assert job.status == JobStatus.ERROR
+        assert job.progress == 9 / 20
+
+class TestImageBatch:
+    """Tests for batched image rendering."""
+
+    def _add_image_jobs(self, manager, temp_dir, count, make_job):
+        for i in range(count):
+            job_id = f"image-{i}"
+            manager._jobs[job_id] = make_job(
+                job_id=job_id,
+                input_path=temp_dir / f"input{i}.png",
+                asset_type=AssetType.IMAGE
+            )
+            manager._pending_images.append(job_id)
+
+    def test_batch_uses_single_ffmpeg_run(self, temp_dir, make_job):
+        """Pending image jobs should be rendered by one ffmpeg process."""
+        manager = JobManager()
+        self._add_image_jobs(manager, temp_dir, 3, make_job)
+
+        def fake_run(cmd, **kwargs):
+            # Create every output the command maps to
+            for i, arg in enumerate(cmd):
+                if arg == "image2":
+                    Path(cmd[i + 1]).touch()
+            return subprocess.CompletedProcess(cmd, 0, stdout="", stderr="done")
+
+        with patch("app.jobs.get_output_path", side_effect=lambda job_id, ext: temp_dir / f"{job_id}.{ext}"), \
+             patch("app.jobs.get_log_path", side_effect=lambda job_id: temp_dir / f"{job_id}.log"), \
+             patch("app.jobs.subprocess.run", side_effect=fake_run) as mock_run:
+            manager._run_image_batch()
+
+        assert mock_run.call_count == 1
+        assert mock_run.call_args[0][0].count("-i") == 3
+        for i in range(3):
+            job = manager.get_job(f"image-{i}")
+            assert job.status == JobStatus.DONE
+            assert list(job.log_lines) == ["done"]
+        assert manager._pending_images == []
+
+    def test_failed_batch_falls_back_to_single_renders(self, temp_dir, make_job):
+        """A failed batch should render each job on its own."""
+        manager = JobManager()
+        self._add_image_jobs(manager, temp_dir, 2, make_job)
+
+        failed = subprocess.CompletedProcess([], 1, stdout="", stderr="error")
+
+        with patch("app.jobs.get_output_path", side_effect=lambda job_id, ext: temp_dir / f"{job_id}.{ext}"), \
+             patch("app.jobs.get_log_path", side_effect=lambda job_id: temp_dir / f"{job_id}.log"), \
+             patch("app.jobs.subprocess.run", return_value=failed), \
+             patch.object(manager, "_run_render") as mock_single:
+            manager._run_image_batch()
+
+        assert [call.args[0] for call in mock_single.call_args_list] == ["image-0", "image-1"]
+        for i in range(2):
+            assert manager.get_job(f"image-{i}").status == JobStatus.QUEUED
+
+    def test_batch_setup_error_marks_jobs_failed(self, temp_dir, make_job):
+        """An error before ffmpeg runs should not leave jobs queued."""
+        manager = JobManager()
+        self._add_image_jobs(manager, temp_dir, 2, make_job)
+
+        with patch("app.jobs.get_output_path", side_effect=OSError("disk full")):
+            manager._run_image_batch()
+
+        for i in range(2):
+            job = manager.get_job(f"image-{i}")
+            assert job.status == JobStatus.ERROR
+            assert "disk full" in job.message
+            assert job.finished_at is not None
+
+    def test_batch_undecodable_stderr_finishes_jobs(self, temp_dir, make_job):
+        """Non-UTF-8 bytes on ffmpeg's stderr should not leave jobs running."""
+        manager = JobManager()
+        self._add_image_jobs(manager, temp_dir, 2, make_job)
+        outputs = [str(temp_dir / f"image-{i}.png") for i in range(2)]
+        # Stand-in for ffmpeg: writes the outputs and a Latin-1 byte to stderr
+        script = (
+            "import sys\n"
+            "for path in sys.argv[1:]: open(path, 'wb').close()\n"
+            "sys.stderr.buffer.write(b'title: caf\\xe9\\n')\n"
+        )
+
+        with patch("app.jobs.get_output_path", side_effect=lambda job_id, ext: temp_dir / f"{job_id}.{ext}"), \
+             patch("app.jobs.get_log_path", side_effect=lambda job_id: temp_dir / f"{job_id}.log"), \
+             patch("app.jobs.build_image_batch_render_command",
+                   return_value=[sys.executable, "-c", script, *outputs]):
+            manager._run_image_batch()
+
+        for i in range(2):
+            job = manager.get_job(f"image-{i}")
+            assert job.status == JobStatus.DONE
+            assert list(job.log_lines) == ["title: caf\ufffd"]
+
 
 class TestJobManagerDependencyInjection:
     """Tests for JobManager dependency injection."""
 
+    @pytest.fixture(autouse=True)
+    def reset_job_manager(self):
+        """Reset the singleton around each test, even if it fails."""
+        set_job_manager(None)
+        yield
+        set_job_manager(None)
+
     def test_get_job_manager_returns_singleton(self):
         """get_job_manager should return a singleton by default."""
-        set_job_manager(None)  # Reset
-
         manager1 = get_job_manager()
         manager2 = get_job_manager()
 
@@ -162,9 +351,6 @@ class TestJobManagerDependencyInjection:
         result = get_job_manager()
         assert result is custom_manager
 
-        # Cleanup
-        set_job_manager(None)
-
     def test_set_job_manager_none_resets(self):
         """set_job_manager(None) should reset to default behavior."""
         custom_manager = JobManager()
@@ -196,7 +382,26 @@ class TestJob:
         assert job.started_at is None
         assert job.finished_at is None
         assert job.process is None
-        assert job.log_lines == []
+        assert len(job.log_lines) == 0
+        assert not job.cancel_event.is_set()
+
+    def test_job_log_lines_bounded(self):
+        """Job log lines should keep only the most recent entries."""
+        job = Job(
+            job_id="test-id",
+            asset_id="asset-123",
+            input_path=Path("/test/input.mp4"),
+            asset_type=AssetType.VIDEO,
+            hex_color="00FF00",
+            similarity=0.4,
+            blend=0.1
+        )
+
+        for i in range(25):
+            job.log_lines.append(f"line {i}")
+
+        assert len(job.log_lines) == LOG_TAIL_LINES
+        assert job.log_lines[-1] == "line 24"
 
     def test_job_video_fields(self):
         """Job should accept video-specific fields."""
@@ -1,7 +1,11 @@
 """Tests for storage module."""
 import uuid
+from pathlib import Path
+from unittest.mock import patch
+
 import pytest
 
+from app.models import AssetType
 from app.storage import (
     generate_id,
     validate_id,
@@ -10,6 +14,13 @@ from app.storage import (
     is_video_extension,
     is_image_extension,
     get_valid_extensions,
+    get_asset_type,
+    get_asset_path,
+    find_asset_path,
+    get_output_path,
+    find_output_path,
+    get_log_path,
+    get_preview_path,
     InvalidIdError,
 )
 
@@ -23,6 +34,16 @@ class TestGenerateId:
         # Should not raise
         uuid.UUID(id_value, version=4)
 
+    def test_generates_canonical_uuid4(self):
+        """Generated IDs should be canonical UUID4 strings accepted by validate_id."""
+        for _ in range(200):
+            id_value = generate_id()
+            parsed = uuid.UUID(id_value)
+            assert parsed.version == 4
+            assert parsed.variant == uuid.RFC_4122
+            assert str(parsed) == id_value
+            assert validate_id(id_value) == id_value
+
     def test_generates_unique_ids(self):
         """Should generate unique IDs."""
         ids = [generate_id() for _ in range(100)]
@@ -62,6 +83,17 @@ class TestValidateId:
         with pytest.raises(InvalidIdError):
             validate_id("")
 
+    def test_non_canonical_forms_rejected(self):
+        """Only the dashed 36-character form should pass."""
+        for value in (
+            "a1b2c3d4e5f64a7b8c9d0e1f2a3b4c5d",
+            "{a1b2c3d4-e5f6-4a7b-8c9d-0e1f2a3b4c5d}",
+            "a1b2c3d4-e5f6-4a7b-8c9d-0e1f2a3b4c5d\n",
+            "a1b2c3d4-e5f6-1a7b-8c9d-0e1f2a3b4c5d",
+        ):
+            with pytest.raises(InvalidIdError):
+                validate_id(value)
+
     def test_uppercase_uuid(self):
         """Uppercase UUIDs are accepted (normalized comparison)."""
         # The implementation compares lowercase forms, so uppercase is accepted
@@ -127,6 +159,17 @@ class TestSafeFilename:
         result = safe_filename("動画.mp4")
         assert ".mp4" in result
 
+    def test_accented_filename(self):
+        """Accented Latin letters should fold to their base letter."""
+        assert safe_filename("caf\u00e9.mp4") == "cafe.mp4"
+        assert safe_filename("cafe\u0301.mp4") == "cafe.mp4"
+        assert safe_filename("\uff21\uff22\uff23.png") == "ABC.png"
+
+    def test_japanese_filename_keeps_voiced_marks(self):
+        """Dakuten should stay attached to their kana."""
+        assert safe_filename("\u30ac\u30a4\u30c9.mp4") == "\u30ac\u30a4\u30c9.mp4"
+        assert safe_filename("\u30ab\u3099.mp4") == "\u30ac.mp4"
+
     def test_command_injection_attempt(self):
         """Command injection attempts should be sanitized."""
         assert "`" not in safe_filename("file`rm -rf /`.mp4")
@@ -160,6 +203,11 @@ class TestGetExtension:
         """Hidden files with extension."""
         assert get_extension(".hidden.mp4") == ".mp4"
 
+    def test_edge_cases_match_pathlib(self):
+        """Dotfiles, trailing dots and directories should behave like Path.suffix."""
+        for filename in (".hidden", "file.", "dir.d/file", "dir/.mp4", "dir/clip.MOV", ""):
+            assert get_extension(filename) == Path(filename).suffix.lower()
+
 
 class TestIsVideoExtension:
     """Tests for is_video_extension function."""
@@ -216,6 +264,22 @@ class TestIsImageExtension:
         assert is_image_extension(".txt") is False
 
 
+class TestGetAssetType:
+    """Tests for get_asset_type function."""
+
+    def test_classifies_extensions(self):
+        """Video and image extensions should map to their asset type."""
+        assert get_asset_type(".mp4") == AssetType.VIDEO
+        assert get_asset_type(".MOV") == AssetType.VIDEO
+        assert get_asset_type(".png") == AssetType.IMAGE
+        assert get_asset_type(".JPG") == AssetType.IMAGE
+
+    def test_unsupported_extension(self):
+        """Unsupported extensions should return None."""
+        assert get_asset_type(".exe") is None
+        assert get_asset_type("") is None
+
+
 class TestGetValidExtensions:
     """Tests for get_valid_extensions function."""
 
@@ -231,7 +295,76 @@ class TestGetValidExtensions:
         assert ".png" in extensions
         assert ".jpg" in extensions
 
-    def test_returns_set(self):
-        """Should return a set."""
+    def test_returns_frozenset(self):
+        """Should return the same immutable set on every call."""
         extensions = get_valid_extensions()
-        assert isinstance(extensions, set)
+        assert isinstance(extensions, frozenset)
+        assert get_valid_extensions() is extensions
+
+
+class TestFindAssetPath:
+    """Tests for find_asset_path function."""
+
+    def test_finds_uploaded_asset(self, mock_storage_dirs):
+        """Should return the path handed out by get_asset_path."""
+        asset_id = generate_id()
+        asset_path = get_asset_path(asset_id, ".mp4")
+        asset_path.write_bytes(b"video")
+
+        assert find_asset_path(asset_id) == asset_path
+
+    def test_finds_asset_on_disk(self, mock_storage_dirs):
+        """Should find inputs written before this process started."""
+        asset_id = generate_id()
+        asset_dir = mock_storage_dirs / "assets" / asset_id
+        asset_dir.mkdir()
+        (asset_dir / "input.png").write_bytes(b"image")
+
+        assert find_asset_path(asset_id) == asset_dir / "input.png"
+
+    def test_missing_asset(self, mock_storage_dirs):
+        """Should return None for unknown or never-written assets."""
+        assert find_asset_path(generate_id()) is None
+
+        asset_id = generate_id()
+        get_asset_path(asset_id, ".mp4")
+        assert find_asset_path(asset_id) is None
+
+
+class TestGetOutputPath:
+    """Tests for get_output_path and get_log_path functions."""
+
+    def test_creates_output_dir(self, mock_storage_dirs):
+        """The output directory should exist once the path is returned."""
+        output_path = get_output_path(generate_id(), "png")
+        assert output_path.parent.is_dir()
+        assert output_path.name == "out.png"
+
+    def test_find_output_path_does_not_create_dir(self, mock_storage_dirs):
+        """Read-only lookups should not create the output directory."""
+        job_id = generate_id()
+        output_path = find_output_path(job_id, "png")
+
+        assert output_path == mock_storage_dirs / "outputs" / job_id / "out.png"
+        assert not output_path.parent.exists()
+        assert get_output_path(job_id, "png") == output_path
+
+    def test_recreates_removed_logs_dir(self, mock_storage_dirs):
+        """A logs directory removed while running should be created again."""
+        get_log_path(generate_id())
+        (mock_storage_dirs / "logs").rmdir()
+
+        log_path = get_log_path(generate_id())
+        assert log_path.parent.is_dir()
+
+
+class TestLazyDataDirs:
+    """Data directories should be created on first use."""
+
+    def test_creates_missing_data_tree(self, temp_dir):
+        """Path helpers should create the data tree from scratch."""
+        data_dir = temp_dir / ".data"
+        with patch("app.storage.PREVIEWS_DIR", data_dir / "previews"), \
+             patch("app.storage.LOGS_DIR", data_dir / "logs"):
+            assert get_preview_path(generate_id()).parent.is_dir()
+            assert get_log_path(generate_id()).parent.is_dir()